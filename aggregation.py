@@ -0,0 +1,75 @@
+"""Agregasi mileage/speed dalam bentuk kolom NumPy.
+
+Titik history dikelompokkan per imei + tanggal. Agregasi selalu per hari;
+rekap periode disusun dari baris harian di tabel historical
+(query_daily_rollups / build_historical_report di main.py).
+"""
+import numpy as np
+
+MAX_JUMP_KM = 500  # delta odometer di atas ini dianggap loncatan GPS
+
+
+
+def history_columns(points, imei=""):
+    """List titik (dict) -> kolom NumPy. Titik tanpa time / mileage dibuang"""
+    valid = [p for p in points if p.get("time") and p.get("mileage") is not None]
+    return {
+        "imei": np.full(len(valid), imei, dtype=object),
+        "time": np.array([p["time"] for p in valid], dtype="U19"),
+        "mileage": np.array([p["mileage"] for p in valid], dtype=float),
+        "speed": np.array([p.get("speed") or 0 for p in valid], dtype=float),
+    }
+
+
+def aggregate_daily(cols):
+    """{(imei, tanggal): {mileage_km, speed_sum, speed_count, point_count}}
+
+    Delta odometer hanya dihitung antar titik di hari yang sama, dan hanya
+    yang 0 < delta < MAX_JUMP_KM. Speed dirata-rata dari titik dengan speed > 1.
+    """
+    n = len(cols["time"])
+    if n == 0:
+        return {}
+
+    order = np.lexsort((cols["time"], cols["imei"].astype(str)))
+    imei = cols["imei"][order]
+    day = cols["time"][order].astype("U10")
+    odo = cols["mileage"][order]
+    speed = cols["speed"][order]
+
+    # data sudah urut per imei lalu waktu -> tiap grup (imei, hari) berurutan
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = (imei[1:] != imei[:-1]) | (day[1:] != day[:-1])
+    group_id = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+
+    delta_km = np.zeros(n)
+    delta_km[1:] = (odo[1:] - odo[:-1]) / 1000
+    delta_km[new_group | (delta_km <= 0) | (delta_km >= MAX_JUMP_KM)] = 0
+
+    moving = speed > 1
+    mileage_km = np.bincount(group_id, weights=delta_km)
+    speed_sum = np.bincount(group_id, weights=np.where(moving, speed, 0))
+    speed_count = np.bincount(group_id, weights=moving)
+    point_count = np.diff(np.append(starts, n))
+
+    return {
+        (imei[s], day[s]): {
+            "mileage_km": float(mileage_km[i]),
+            "speed_sum": float(speed_sum[i]),
+            "speed_count": int(speed_count[i]),
+            "point_count": int(point_count[i])
+        }
+        for i, s in enumerate(starts)
+    }
+
+
+def summarize_days(days):
+    """Rekap periode dari row harian: total mileage & rata-rata dari rata-rata speed harian"""
+    speed_avgs = [g["avg_speed"] for g in days.values() if g["speed_count"]]
+    return {
+        "mileage_km": sum(g["mileage_km"] for g in days.values()),
+        "avg_speed": sum(speed_avgs) / len(speed_avgs) if speed_avgs else 0,
+        "speed_count": sum(g["speed_count"] for g in days.values()),
+        "point_count": sum(g["point_count"] for g in days.values())
+    }
@@ -0,0 +1,257 @@
+"""Server palsu portal.gps.id untuk benchmark (stdlib saja, tanpa dependency).
+
+Endpoint yang ditiru (path sama dengan GPS_BASE_URL asli):
+
+    POST /login               -> {"message": {"data": {"token": ...}}}
+    GET  /vehicle             -> {"message": {"data": [ {imei, plate, ...} ]}}
+    GET  /report/history      -> {"message": {"data": [...], "last_page": N}}
+    GET  /__stats             -> jumlah call per endpoint (untuk harness)
+    POST /__reset             -> nol-kan counter
+
+Track dibuat deterministik per (imei, tanggal) oleh FleetGenerator: parkir
+malam, berangkat pagi, selang-seling jalan/berhenti, pulang sore. Odometer
+(meter) naik sesuai kecepatan x waktu dan selalu monoton antar hari.
+
+    python bench/fake_gps.py --vehicles 50 --interval 30 --latency-ms 80 --rate429 0.02
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DAY_STRIDE_M = 2_000_000  # odometer awal tiap hari = indeks hari x stride (> jarak harian maksimum)
+EPOCH = datetime(2024, 1, 1)
+JAKARTA = (-6.2, 106.82)
+
+
+class FleetGenerator:
+    """Armada sintetis: N kendaraan, titik tiap `interval` detik saat mesin hidup"""
+
+    def __init__(self, vehicles=20, interval=30, parked_interval=300, seed=42):
+        self.interval = interval
+        self.parked_interval = parked_interval
+        self.seed = seed
+        rnd = random.Random(seed)
+        self.vehicles = [{
+            "imei": str(860000000000000 + i),
+            "plate": f"B {1000 + i} BN",
+            "device_name": rnd.choice(["Innova Diesel 2.4 G", "Daihatsu Terrios X AT MC", "Suzuki Carry Pick Up"]),
+            "fuel_type": rnd.choice(["Solar", "Pertalite", "Pertamax"]),
+        } for i in range(vehicles)]
+        self.by_imei = {v["imei"]: i for i, v in enumerate(self.vehicles)}
+        self.day_points = lru_cache(maxsize=4096)(self._day_points)
+
+    def _day_points(self, imei, day):
+        """Semua titik satu kendaraan untuk satu tanggal (YYYY-MM-DD)"""
+        day_dt = datetime.strptime(day, "%Y-%m-%d")
+        day_index = (day_dt - EPOCH).days
+        rnd = random.Random(f"{self.seed}:{imei}:{day}")
+        vidx = self.by_imei.get(imei, 0)
+
+        # garasi tiap kendaraan tersebar di sekitar Jakarta
+        home = random.Random(f"{self.seed}:{imei}")
+        lat = JAKARTA[0] + home.uniform(-0.15, 0.15)
+        lon = JAKARTA[1] + home.uniform(-0.2, 0.2)
+        odo = day_index * DAY_STRIDE_M + vidx * 997
+        heading = rnd.uniform(0, 2 * math.pi)
+
+        depart = rnd.randint(6 * 3600, 8 * 3600)
+        arrive = rnd.randint(16 * 3600, 19 * 3600)
+        off_day = rnd.random() < 0.1  # kadang kendaraan tidak jalan seharian
+
+        points = []
+        t = 0
+        speed = 0.0
+        mode, mode_until = "parked", 0
+        while t < 86400:
+            working = not off_day and depart <= t < arrive
+            if not working:
+                mode = "parked"
+            elif mode == "drive" and t >= mode_until:
+                mode, mode_until = "stop", t + rnd.randint(2, 30) * 60
+            elif mode != "drive" and t >= mode_until:
+                mode, mode_until = "drive", t + rnd.randint(10, 60) * 60
+
+            engine = mode != "parked"
+            if mode == "drive":
+                speed = min(90.0, max(5.0, speed + rnd.gauss(0, 8)))
+                heading += rnd.gauss(0, 0.25)
+            else:
+                speed = 0.0
+            step = self.parked_interval if mode == "parked" else self.interval
+
+            points.append({
+                "time": (day_dt + timedelta(seconds=t)).strftime("%Y-%m-%d %H:%M:%S"),
+                "mileage": round(odo),
+                "speed": round(speed),
+                "lat": round(lat, 6),
+                "lon": round(lon, 6),
+                "engine": int(engine),
+            })
+
+            dist = speed / 3.6 * step
+            odo += dist
+            lat += dist * math.cos(heading) / 111_320
+            lon += dist * math.sin(heading) / (111_320 * math.cos(math.radians(lat)))
+            t += step
+        return points
+
+    def points(self, imei, start, end):
+        """Titik antara start..end ("YYYY-MM-DD HH:MM:SS")"""
+        out = []
+        day = datetime.strptime(start[:10], "%Y-%m-%d")
+        last = datetime.strptime(end[:10], "%Y-%m-%d")
+        while day <= last:
+            for p in self.day_points(imei, day.strftime("%Y-%m-%d")):
+                if start <= p["time"] <= end:
+                    out.append(p)
+            day += timedelta(days=1)
+        return out
+
+    def vehicle_list(self):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return [{
+            "imei": v["imei"],
+            "plate": v["plate"],
+            "device_name": v["device_name"],
+            "speed": random.randint(0, 80),
+            "mileage": random.randint(10_000_000, 90_000_000),
+            "last_update": now,
+        } for v in self.vehicles]
+
+
+class FakeGPSServer:
+    """ThreadingHTTPServer + counter. Bisa dipakai in-process atau dari CLI"""
+
+    def __init__(self, fleet, port=0, latency_ms=0, max_per_page=10000, rate429=0.0, retry_after=1):
+        self.fleet = fleet
+        self.latency_ms = latency_ms
+        self.max_per_page = max_per_page
+        self.rate429 = rate429
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.points_served = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def count(self, key, points=0):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.points_served += points
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "total": sum(self.calls.values()), "points": self.points_served}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.points_served = 0
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-gps", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def throttled(self, endpoint):
+                if server.latency_ms:
+                    time.sleep(server.latency_ms / 1000)
+                if server.rate429 and random.random() < server.rate429:
+                    server.count(f"{endpoint}_429")
+                    self.send_json(429, {"message": "Too Many Requests"}, {"Retry-After": str(server.retry_after)})
+                    return True
+                return False
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                path = urlparse(self.path).path
+                if path == "/__reset":
+                    server.reset()
+                    return self.send_json(200, {"ok": True})
+                if path.endswith("/login"):
+                    server.count("login")
+                    if self.throttled("login"):
+                        return
+                    return self.send_json(200, {"message": {"data": {"token": "bench-token"}}})
+                self.send_json(404, {"message": "not found"})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == "/__stats":
+                    return self.send_json(200, server.stats())
+                if url.path.endswith("/vehicle"):
+                    server.count("vehicle")
+                    if self.throttled("vehicle"):
+                        return
+                    return self.send_json(200, {"message": {"data": server.fleet.vehicle_list()}})
+                if url.path.endswith("/report/history"):
+                    if self.throttled("history"):
+                        return
+                    per_page = min(int(query.get("per_page", 10000)), server.max_per_page)
+                    page = int(query.get("page", 1))
+                    points = server.fleet.points(query["device"], query["start"], query["end"])
+                    last_page = max(1, math.ceil(len(points) / per_page))
+                    data = points[(page - 1) * per_page:page * per_page]
+                    server.count("history", len(data))
+                    return self.send_json(200, {"message": {"data": data, "last_page": last_page}})
+                self.send_json(404, {"message": "not found"})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--vehicles", type=int, default=20)
+    parser.add_argument("--interval", type=int, default=30, help="detik antar titik saat mesin hidup")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--max-per-page", type=int, default=10000)
+    parser.add_argument("--rate429", type=float, default=0.0, help="peluang tiap request dibalas 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    server = FakeGPSServer(FleetGenerator(args.vehicles, args.interval), args.port, args.latency_ms,
+                           args.max_per_page, args.rate429, args.retry_after)
+    print(f"fake GPS.id di {server.url} ({args.vehicles} kendaraan) -- set GPS_BASE_URL={server.url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Benchmark route utama terhadap server GPS.id palsu.
+
+Harness ini menjalankan bench/fake_gps.py di subprocess (CPU-nya tidak ikut
+terhitung), menyiapkan working dir sementara berisi vehicles.db dan
+data_kendaraan.xlsx untuk armada sintetis, lalu memanggil tiap route lewat
+Flask test client. Per route dilaporkan dua kali: cold (store/cache dikosongkan
+dulu) dan warm (diulang langsung), berisi latency, jumlah call API, CPU time,
+dan peak memory (tracemalloc).
+
+    python bench/run.py                          # 10 kendaraan x 7 hari
+    python bench/run.py --vehicles 50 --days 30 --latency-ms 80 --rate429 0.02
+    python bench/run.py --routes dashboard,maps --json hasil.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from fake_gps import FleetGenerator  # noqa: E402
+
+
+def start_fake_server(args):
+    cmd = [sys.executable, os.path.join(ROOT, "bench", "fake_gps.py"), "--port", "0",
+           "--vehicles", str(args.vehicles), "--interval", str(args.interval),
+           "--latency-ms", str(args.latency_ms), "--max-per-page", str(args.max_per_page),
+           "--rate429", str(args.rate429), "--retry-after", str(args.retry_after)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    url = line.split()[3]  # "fake GPS.id di http://127.0.0.1:PORT ..."
+    return proc, url
+
+
+def fake_stats(url):
+    with urllib.request.urlopen(url + "/__stats") as res:
+        return json.load(res)
+
+
+def fake_reset(url):
+    urllib.request.urlopen(urllib.request.Request(url + "/__reset", data=b"", method="POST")).close()
+
+
+def prepare_workdir(workdir, fleet):
+    """data_kendaraan.xlsx untuk /maps (vehicles.db diisi setelah main di-import)"""
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(os.path.join(workdir, "data_kendaraan.xlsx"))
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, ["imei", "plate", "device_name"])
+    for i, v in enumerate(fleet.vehicles, start=1):
+        sheet.write_row(i, 0, [v["imei"], v["plate"], v["device_name"]])
+    workbook.close()
+
+
+def seed_vehicles(main, fleet):
+    main.sync_vehicles(fleet.vehicle_list())
+    main.vehicles_db.executemany(
+        "UPDATE vehicles_status SET status='Aktif', fuel_type=? WHERE imei=?",
+        [(v["fuel_type"], v["imei"]) for v in fleet.vehicles]
+    )
+
+
+def reset_state(main):
+    """Kosongkan semua store & cache supaya request berikutnya benar-benar cold"""
+    main.daily_cache.clear()
+    conn = main.history_conn()
+    with conn:
+        for table in ("history_points", "history_days", "track_pyramids", "trips", "trip_days",
+                      "geo_buckets", "geo_days", "geo_index"):
+            conn.execute(f"DELETE FROM {table}")
+    conn.close()
+    conn = main.historical_conn()
+    with conn:
+        conn.execute("DELETE FROM historical")
+    conn.close()
+    main.vehicle_snapshot.data = None
+
+
+def scenarios(fleet, start, end):
+    plate = fleet.vehicles[0]["plate"]
+    # garasi kendaraan pertama (titik pertama hari itu) untuk query geofence
+    home = fleet.points(fleet.vehicles[0]["imei"], f"{start} 00:00:00", f"{start} 23:59:59")[0]
+    plates = "&".join(f"plate={v['plate']}" for v in fleet.vehicles[:10])
+    return [
+        ("dashboard", "GET", f"/?start_time={start}&end_time={end}", None),
+        ("historical", "GET", f"/historical?start_date={start}&end_date={end}", None),
+        ("historical_detail", "GET", f"/historical/detail?plate={plate}&start={start}&end={end}", None),
+        ("maps", "POST", "/maps", {"plate": plate, "start_time": f"{start}T00:00", "end_time": f"{end}T23:59"}),
+        ("api_tracks", "GET", f"/api/tracks?{plates}&start={start}&end={end}&zoom=12", None),
+        ("api_trips", "GET", f"/api/trips?start={start}&end={end}", None),
+        ("api_visits", "GET", f"/api/visits?lat={home['lat']}&lon={home['lon']}&radius_m=300&start={start}&end={end}", None),
+        ("api_emissions", "GET", f"/api/emissions?start_date={start}&end_date={end}", None),
+        ("export_xlsx", "GET", f"/export?start_date={start}&end_date={end}", None),
+        ("vehicles", "GET", "/vehicles", None),
+    ]
+
+
+def measure(client, fake_url, method, path, data, trace):
+    fake_reset(fake_url)
+    if trace:
+        tracemalloc.reset_peak()
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    # print() dari app (log per request, progress fetch) tidak ikut ke tabel hasil
+    with contextlib.redirect_stdout(io.StringIO()):
+        res = client.post(path, data=data) if method == "POST" else client.get(path)
+        body = res.get_data()
+    wall, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    peak = tracemalloc.get_traced_memory()[1] if trace else None
+    stats = fake_stats(fake_url)
+    return {
+        "status": res.status_code,
+        "latency_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "peak_mb": round(peak / 2 ** 20, 1) if peak is not None else None,
+        "api_calls": stats["total"],
+        "api_429": sum(v for k, v in stats["calls"].items() if k.endswith("_429")),
+        "points": stats["points"],
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vehicles", type=int, default=10)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--start", default="2025-03-01")
+    parser.add_argument("--interval", type=int, default=30, help="detik antar titik saat mesin hidup")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--max-per-page", type=int, default=10000)
+    parser.add_argument("--rate429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=50, help="GPS_RATE_PER_SEC untuk app")
+    parser.add_argument("--routes", default="", help="subset route, dipisah koma")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="tanpa peak memory (latency lebih murni)")
+    parser.add_argument("--json", default="", help="simpan hasil ke file JSON")
+    parser.add_argument("--keep", action="store_true", help="jangan hapus working dir")
+    args = parser.parse_args()
+
+    start = args.start
+    end = (datetime.strptime(start, "%Y-%m-%d") + timedelta(days=args.days - 1)).strftime("%Y-%m-%d")
+    fleet = FleetGenerator(args.vehicles, args.interval)
+    proc, fake_url = start_fake_server(args)
+    workdir = tempfile.mkdtemp(prefix="jala-bench-")
+    results = []
+    try:
+        prepare_workdir(workdir, fleet)
+        os.chdir(workdir)
+        os.environ.update({
+            "GPS_BASE_URL": fake_url,
+            "GPS_USERNAME": "bench",
+            "GPS_PASSWORD": "bench",
+            "GPS_RATE_PER_SEC": str(args.rate),
+            "GPS_RATE_BURST": str(max(3, int(args.rate))),
+            "HISTORY_DB": os.path.join(workdir, "telemetry.db"),
+            "CACHE_DB": "",
+            "PREWARM_AT": "",
+        })
+        sys.path.insert(0, ROOT)
+        import main as app_main
+        import logging
+        logging.disable(logging.INFO)
+
+        app_main.init_db()
+        app_main.init_history_store()
+        app_main.init_historical_db()
+        seed_vehicles(app_main, fleet)
+        client = app_main.app.test_client()
+
+        selected = set(filter(None, args.routes.split(",")))
+        trace = not args.no_tracemalloc
+        if trace:
+            tracemalloc.start()
+
+        print(f"{args.vehicles} kendaraan x {args.days} hari ({start} → {end}), "
+              f"titik tiap {args.interval}s, latency {args.latency_ms}ms, 429 {args.rate429:.0%}")
+        header = f"{'route':<18} {'run':<5} {'status':>6} {'latency s':>10} {'cpu s':>7} {'peak MB':>8} {'API':>6} {'429':>4} {'titik':>9} {'bytes':>9}"
+        print(header)
+        print("-" * len(header))
+        for name, method, path, data in scenarios(fleet, start, end):
+            if selected and name not in selected:
+                continue
+            reset_state(app_main)
+            for run in ("cold", "warm"):
+                r = measure(client, fake_url, method, path, data, trace)
+                r.update({"route": name, "run": run})
+                results.append(r)
+                peak = f"{r['peak_mb']:.1f}" if r["peak_mb"] is not None else "-"
+                print(f"{name:<18} {run:<5} {r['status']:>6} {r['latency_s']:>10.3f} {r['cpu_s']:>7.3f} {peak:>8} "
+                      f"{r['api_calls']:>6} {r['api_429']:>4} {r['points']:>9} {r['bytes']:>9}")
+
+        if args.json:
+            out = args.json if os.path.isabs(args.json) else os.path.join(ROOT, args.json)
+            with open(out, "w") as f:
+                json.dump({"args": vars(args), "results": results}, f, indent=2)
+            print(f"\nhasil disimpan di {out}")
+    finally:
+        os.chdir(ROOT)
+        proc.terminate()
+        if args.keep:
+            print(f"working dir: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
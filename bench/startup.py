@@ -0,0 +1,77 @@
+"""Benchmark waktu start: berapa lama `import main` dan modul mana yang paling berat.
+
+Pakai `python -X importtime` di subprocess baru (cold import), diulang beberapa
+kali lalu diambil median-nya.
+
+    python bench/startup.py            # 5 kali, tampilkan 20 modul teratas
+    python bench/startup.py -n 10 --top 40
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_once():
+    """Satu cold import. Return (detik wall, {modul: (self_us, cumulative_us)})"""
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        sys.exit(f"import main gagal:\n{proc.stderr[-2000:]}")
+
+    modules = {}
+    for line in proc.stderr.splitlines():
+        # format: "import time:   self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(self_us), int(cum_us))
+    return wall, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    walls, runs = [], []
+    for _ in range(args.runs):
+        wall, modules = import_once()
+        walls.append(wall)
+        runs.append(modules)
+
+    # median per modul dari semua run
+    names = set().union(*runs)
+    median = {
+        name: (statistics.median(r[name][0] for r in runs if name in r),
+               statistics.median(r[name][1] for r in runs if name in r))
+        for name in names
+    }
+
+    print(f"python {sys.version.split()[0]}, {args.runs} run")
+    print(f"wall `import main` (termasuk start interpreter): "
+          f"median {statistics.median(walls) * 1000:.0f} ms, min {min(walls) * 1000:.0f} ms")
+    if "main" in median:
+        print(f"import main (cumulative): {median['main'][1] / 1000:.0f} ms")
+    print()
+    print(f"{'cumulative ms':>14} {'self ms':>9}  modul")
+    top = sorted(median.items(), key=lambda kv: kv[1][1], reverse=True)[:args.top]
+    for name, (self_us, cum_us) in top:
+        print(f"{cum_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+    heavy = [m for m in ("pandas", "matplotlib", "openpyxl", "pytz") if m in median]
+    print()
+    print("modul berat yang ikut ter-import:", ", ".join(heavy) if heavy else "tidak ada")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,71 @@
-from flask import Flask, request, render_template, redirect, url_for, jsonify
+from flask import Flask, request, render_template, redirect, url_for, jsonify, g
 import requests
 import time
 import os
 import logging
+import pickle
+import queue
+import random
+import bisect
+import sys
+import threading
+import uuid
+import csv
+import tempfile
+import gzip
+import hashlib
+import json
+import hmac
+import cProfile
+import pstats
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from collections import defaultdict
-import pandas as pd
+from collections import OrderedDict, defaultdict, deque
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
 from dotenv import load_dotenv
-import pytz
 import io
 from flask import send_file
-
-import matplotlib
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from aggregation import MAX_JUMP_KM, aggregate_daily, summarize_days
+from telemetry import (
+    HISTORY_FIELDS, LOCAL_TZ, init_history_store, history_conn, geo_rtree_available,
+    local_today, local_yesterday, date_range, contiguous_runs, get_stored_days,
+    load_stored_history, save_history_chunk, iter_day_columns
+)
 
 logging.getLogger('werkzeug').disabled = True
 
 # SETUP LOGGING
+# LOG_FORMAT=json -> satu objek JSON per baris (untuk log collector)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_log_handler = logging.StreamHandler()  # tampil di console
+if LOG_FORMAT == "json":
+    _log_handler.setFormatter(JsonLogFormatter())
 logging.basicConfig(
     level=logging.INFO,  # Level default: INFO (bisa DEBUG, WARNING, ERROR)
     format="%(asctime)s [%(levelname)s] %(message)s",
     handlers=[
-        logging.StreamHandler()  # tampil di console
+        _log_handler
         # logging.FileHandler("app.log")  # kalau mau simpan ke file
     ]
 )
@@ -54,139 +96,717 @@ gps_config = {
     'password': os.getenv('GPS_PASSWORD')
 }
 
-_token_cache = {"token": None, "expires_at": 0}
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+# =========================== METRICS ===========================
+# Registry kecil gaya Prometheus tanpa dependency: counter & histogram
+# berlabel, plus collector yang baru dibaca saat /metrics di-scrape (statistik
+# cache, snapshot kendaraan, dll).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # nama -> (tipe, help)
+        self.buckets = {}
+        self.counters = defaultdict(float)  # (nama, label) -> nilai
+        self.histograms = {}  # (nama, label) -> [jumlah per bucket..., sum, count]
+        self.collectors = []
+
+    def describe(self, name, metric_type, help_text, buckets=LATENCY_BUCKETS):
+        self.meta[name] = (metric_type, help_text)
+        if metric_type == "histogram":
+            self.buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.buckets[name]
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            if i < len(buckets):
+                h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def collector(self, fn):
+        """fn() -> iterable (nama, {label}, nilai); dipanggil tiap render"""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        with self.lock:
+            samples = defaultdict(list)
+            for (name, labels), value in self.counters.items():
+                samples[name].append((dict(labels), value))
+            histograms = defaultdict(list)
+            for (name, labels), h in self.histograms.items():
+                histograms[name].append((dict(labels), list(h)))
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    samples[name].append((labels, value))
+            except Exception:
+                logging.exception(f"🚨 Collector metrics {fn.__name__} gagal")
+
+        lines = []
+        for name, (metric_type, help_text) in sorted(self.meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for labels, h in histograms.get(name, []):
+                    cumulative = 0
+                    for le, n in zip(self.buckets[name], h):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {h[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {h[-2]:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {h[-1]}")
+            else:
+                for labels, value in samples.get(name, []):
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(v):
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(str(v))}"' for k, v in labels.items()) + "}"
+
+
+metrics = Metrics()
+metrics.describe("http_request_duration_seconds", "histogram", "Latency request Flask per route")
+metrics.describe("gps_requests_total", "counter", "Request ke API GPS.id per endpoint dan status HTTP")
+metrics.describe("gps_request_duration_seconds", "histogram", "Latency satu request ke API GPS.id")
+metrics.describe("gps_throttled_total", "counter", "Jawaban 429 dari API GPS.id")
+metrics.describe("gps_retry_after_seconds_total", "counter", "Total Retry-After (detik) yang diminta API GPS.id")
+metrics.describe("gps_ratelimit_wait_seconds_total", "counter", "Waktu tidur di rate limiter sebelum request ke GPS.id")
+metrics.describe("gps_retries_total", "counter", "Retry request GPS.id per alasan")
+metrics.describe("history_points_fetched_total", "counter", "Titik history yang diambil dari API per kendaraan")
+metrics.describe("rollup_points_total", "counter", "Titik yang direkap ke rollup harian per kendaraan")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
 
 @app.after_request
 def custom_log(response):
-    jakarta = pytz.timezone("Asia/Jakarta")
-    now = datetime.now(jakarta).strftime("%Y-%m-%d %H:%M:%S")
-    print(
-        f"[{now}] {request.remote_addr} {request.method} {request.path} {response.status_code}"
-    )
+    duration = time.perf_counter() - g.get("request_started", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("http_request_duration_seconds", duration,
+                    route=route, method=request.method, status=response.status_code)
+    if LOG_FORMAT == "json":
+        logging.getLogger("access").info("request", extra={"fields": {
+            "remote": request.remote_addr,
+            "method": request.method,
+            "route": route,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 1),
+        }})
+    else:
+        now = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        print(
+            f"[{now}] {request.remote_addr} {request.method} {request.path} {response.status_code} {duration * 1000:.0f}ms"
+        )
     return response
 
+
+@app.route('/metrics')
+def metrics_route():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# =========================== PROFILING ===========================
+# Profil per request, opt-in:
+# - ?profile=1 atau header X-Profile: 1 -> cProfile penuh untuk request itu.
+#   Butuh token PROFILE_TOKEN (header X-Profile-Token / ?profile_token=);
+#   kalau PROFILE_TOKEN kosong trigger manual dan /debug/profiles nonaktif
+#   (di belakang reverse proxy remote_addr selalu loopback, jadi tidak bisa
+#   dipakai sebagai pengganti token).
+# - PROFILE_SLOW_MS > 0 -> sampler ringan mengambil stack thread request tiap
+#   PROFILE_SAMPLE_MS; hasilnya hanya disimpan kalau request lebih lambat dari
+#   ambang itu.
+# Tiap capture berisi route, parameter, durasi per tahap (fetch / aggregate /
+# render, dicatat view lewat mark_stage) dan profilnya. Disimpan di memori
+# (PROFILE_KEEP terakhir) dan dilihat di /debug/profiles.
+# Catatan: fetch paralel jalan di thread worker (run_parallel), jadi di profil
+# thread request waktunya tampak sebagai menunggu; rinciannya ada di tahap.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", 0))  # 0 = capture otomatis nonaktif
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", 5))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50))
+PROFILE_TOP = 40  # baris fungsi / stack yang disimpan per capture
+PROFILE_SKIP_ENDPOINTS = {"static", "metrics_route", "profiles_view", "profile_detail"}
+
+profile_captures = deque(maxlen=PROFILE_KEEP)
+_profile_lock = threading.Lock()
+
+metrics.describe("http_request_stage_seconds", "histogram", "Durasi per tahap request (fetch/aggregate/render)")
+metrics.describe("profile_captures_total", "counter", "Capture profil yang disimpan per mode")
+
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class StackSampler:
+    """Satu thread daemon yang mengambil stack thread-thread request secara berkala"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}  # thread ident -> {stack: jumlah sample}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def begin(self, ident):
+        with self.lock:
+            self.active[ident] = defaultdict(int)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="profile-sampler", daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def end(self, ident):
+        with self.lock:
+            return self.active.pop(ident, None)
+
+    def _loop(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.active:
+                    self.wake.clear()
+                    continue
+                for ident, counts in self.active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None and len(stack) < 64:
+                        stack.append(frame_label(frame.f_code))
+                        frame = frame.f_back
+                    if stack:
+                        counts[";".join(reversed(stack))] += 1
+            del frames
+
+
+profile_sampler = StackSampler(PROFILE_SAMPLE_MS / 1000)
+
+
+def profile_authorized():
+    if not PROFILE_TOKEN:
+        return False
+    token = request.headers.get("X-Profile-Token") or request.args.get("profile_token", "")
+    return hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def mark_stage(name):
+    """Catat waktu sejak tanda sebelumnya (atau awal request) sebagai tahap `name`"""
+    now = time.perf_counter()
+    stages = g.setdefault("stages", {})
+    stages[name] = stages.get(name, 0) + now - g.get("stage_mark", g.get("request_started", now))
+    g.stage_mark = now
+
+
+def cprofile_report(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+
+def sample_report(counts):
+    """Fungsi teratas (self & inclusive) + stack terbanyak dari hasil sampler"""
+    total = sum(counts.values())
+    own, inclusive = defaultdict(int), defaultdict(int)
+    for stack, n in counts.items():
+        frames = stack.split(";")
+        own[frames[-1]] += n
+        for f in set(frames):
+            inclusive[f] += n
+
+    def table(title, rows):
+        lines = [title, f"{'sample':>8} {'%':>6}  fungsi"]
+        for label, n in sorted(rows.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_TOP]:
+            lines.append(f"{n:>8} {n / total:>6.1%}  {label}")
+        return "\n".join(lines)
+
+    stacks = "\n".join(f"{n} {stack}" for stack, n in
+                       sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_TOP])
+    return "\n\n".join([
+        f"{total} sample tiap {PROFILE_SAMPLE_MS:g} ms",
+        table("SELF", own),
+        table("INCLUSIVE", inclusive),
+        "STACK (format collapsed, bisa langsung ke flamegraph.pl)\n" + stacks,
+    ])
+
+
+@app.before_request
+def start_profiling():
+    g.stage_mark = g.get("request_started", time.perf_counter())
+    if request.endpoint in PROFILE_SKIP_ENDPOINTS:
+        return
+    if (request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1") and profile_authorized():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    elif PROFILE_SLOW_MS > 0:
+        g.profile_thread = threading.get_ident()
+        profile_sampler.begin(g.profile_thread)
+
+
+@app.after_request
+def finish_profiling(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    counts = profile_sampler.end(g.pop("profile_thread")) if "profile_thread" in g else None
+    duration = time.perf_counter() - g.get("request_started", time.perf_counter())
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    stages = g.get("stages")
+    if stages:
+        mark_stage("render")  # sisa setelah tahap terakhir: render template / tulis file
+        for name, seconds in stages.items():
+            metrics.observe("http_request_stage_seconds", seconds, route=route, stage=name)
+
+    if profiler is None and (counts is None or duration * 1000 < PROFILE_SLOW_MS):
+        return response
+
+    params = {k: v for k, v in request.values.items() if k != "profile_token"}
+    capture = {
+        "id": uuid.uuid4().hex[:12],
+        "time": datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"),
+        "method": request.method,
+        "route": route,
+        "path": request.path,
+        "params": params,
+        "status": response.status_code,
+        "duration_ms": round(duration * 1000, 1),
+        "stages_ms": {name: round(s * 1000, 1) for name, s in (stages or {}).items()},
+        "mode": "cprofile" if profiler is not None else "sample",
+        "report": cprofile_report(profiler) if profiler is not None else sample_report(counts or {}),
+    }
+    with _profile_lock:
+        profile_captures.append(capture)
+    metrics.inc("profile_captures_total", mode=capture["mode"])
+    logging.info(f"🐢 Profil {capture['mode']} {request.method} {request.path} "
+                 f"{capture['duration_ms']:.0f}ms disimpan ({capture['id']})")
+
+    if profiler is not None:
+        timings = [f"{name};dur={ms}" for name, ms in capture["stages_ms"].items()]
+        response.headers["Server-Timing"] = ", ".join(timings + [f"total;dur={capture['duration_ms']}"])
+        response.headers["X-Profile-Id"] = capture["id"]
+    return response
+
+
+@app.teardown_request
+def abort_profiling(exc):
+    # after_request tidak jalan (mis. exception di tengah response): jangan
+    # tinggalkan profiler aktif / thread di sampler
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    if "profile_thread" in g:
+        profile_sampler.end(g.pop("profile_thread"))
+
+
+@app.route('/debug/profiles')
+def profiles_view():
+    """Capture terlambat dulu; ?format=json untuk mentahnya"""
+    if not PROFILE_TOKEN:
+        return "Profiling nonaktif (PROFILE_TOKEN belum diset)", 404
+    if not profile_authorized():
+        return "Tidak diizinkan", 403
+    with _profile_lock:
+        captures = sorted(profile_captures, key=itemgetter("duration_ms"), reverse=True)
+    rows = [{k: v for k, v in c.items() if k != "report"} for c in captures]
+    if request.args.get("format") == "json":
+        return jsonify({"slow_ms": PROFILE_SLOW_MS, "captures": rows})
+    return render_template("profiles.html", captures=rows, slow_ms=PROFILE_SLOW_MS,
+                           token=request.args.get("profile_token", ""))
+
+
+@app.route('/debug/profiles/<capture_id>')
+def profile_detail(capture_id):
+    if not PROFILE_TOKEN:
+        return "Profiling nonaktif (PROFILE_TOKEN belum diset)", 404
+    if not profile_authorized():
+        return "Tidak diizinkan", 403
+    with _profile_lock:
+        capture = next((c for c in profile_captures if c["id"] == capture_id), None)
+    if capture is None:
+        return "Capture tidak ditemukan", 404
+    header = "\n".join([
+        f"{capture['method']} {capture['path']} -> {capture['status']} "
+        f"({capture['duration_ms']} ms, {capture['time']}, {capture['mode']})",
+        f"route : {capture['route']}",
+        f"param : {json.dumps(capture['params'], ensure_ascii=False)}",
+        "tahap : " + (", ".join(f"{k} {v} ms" for k, v in capture["stages_ms"].items()) or "-"),
+    ])
+    return app.response_class(header + "\n\n" + capture["report"], mimetype="text/plain; charset=utf-8")
+
 # =========================== DATABASE ===========================
 import sqlite3
 
 DB_FILE = "vehicles.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+
+
+class SQLitePool:
+    """Koneksi SQLite yang dipakai ulang antar request.
+
+    Tiap koneksi dipinjam satu thread pada satu waktu, jadi cache prepared
+    statement milik koneksi ikut terpakai ulang. Mode WAL: penulis tidak
+    memblok pembaca (dashboard tetap jalan saat ada update status/nama/BBM).
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Satu transaksi (satu commit) untuk beberapa statement sekaligus"""
+        with self.connection() as conn:
+            with conn:
+                yield conn
+
+    def query(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def execute(self, sql, params=()):
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with self.transaction() as conn:
+            return conn.executemany(sql, rows).rowcount
+
+    def insert(self, sql, params=()):
+        """INSERT satu baris, return rowid-nya"""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).lastrowid
+
+
+vehicles_db = SQLitePool(DB_FILE)
+_db_init_lock = threading.Lock()  # init tabel/DB lazy (historical.db, geofences)
+
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS vehicles_status (
-            imei TEXT PRIMARY KEY,
-            plate TEXT,
-            device_name TEXT,
-            custom_name TEXT,              
-            status TEXT DEFAULT 'Tidak Aktif'
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with vehicles_db.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS vehicles_status (
+                imei TEXT PRIMARY KEY,
+                plate TEXT,
+                device_name TEXT,
+                custom_name TEXT,
+                status TEXT DEFAULT 'Tidak Aktif',
+                fuel_type TEXT DEFAULT 'None'
+            )
+        """)
+        existing = {r[1] for r in conn.execute("PRAGMA table_info(vehicles_status)")}
+        for col, col_type in (("custom_name", "TEXT"), ("fuel_type", "TEXT DEFAULT 'None'")):
+            if col not in existing:
+                conn.execute(f"ALTER TABLE vehicles_status ADD COLUMN {col} {col_type}")
 
 def get_status(imei):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT status FROM vehicles_status WHERE imei=?", (imei,))
-    row = c.fetchone()
-    conn.close()
+    row = vehicles_db.query_one("SELECT status FROM vehicles_status WHERE imei=?", (imei,))
     return row[0] if row else "Tidak Aktif"
 
 def upsert_vehicle(imei, plate, device_name):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
+    vehicles_db.execute("""
         INSERT OR IGNORE INTO vehicles_status (imei, plate, device_name, status)
         VALUES (?, ?, ?, 'Tidak Aktif')
     """, (imei, plate, device_name))
-    conn.commit()
-    conn.close()
 
 def update_status(imei, status):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE vehicles_status SET status=? WHERE imei=?", (status, imei))
-    conn.commit()
-    conn.close()
+    vehicles_db.execute("UPDATE vehicles_status SET status=? WHERE imei=?", (status, imei))
 
 # 🔹 Fungsi baru untuk update custom_name
 def update_custom_name(imei, custom_name):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE vehicles_status SET custom_name=? WHERE imei=?", (custom_name, imei))
-    conn.commit()
-    conn.close()
+    vehicles_db.execute("UPDATE vehicles_status SET custom_name=? WHERE imei=?", (custom_name, imei))
+
+def update_vehicle_fuel_type(imei, fuel_type):
+    vehicles_db.execute("UPDATE vehicles_status SET fuel_type=? WHERE imei=?", (fuel_type, imei))
+
+class TokenBucket:
+    """Rate limiter bersama untuk semua thread yang memanggil API GPS.id.
+
+    Kecepatan naik pelan-pelan selama API tidak menolak (additive increase)
+    dan dipotong setengah tiap kena 429 (multiplicative decrease).
+    """
+
+    def __init__(self, rate, burst=1, min_rate=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Tunggu sampai ada token. Return lama menunggu (detik)"""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def penalize(self, retry_after):
+        """API balas 429: semua thread berhenti selama Retry-After, lalu rate diturunkan"""
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+
+def parse_retry_after(value, default=60):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
 
-# =========================== TOKEN HANDLER ===========================
-def get_token():
-    now = time.time()
-    if _token_cache["token"] and now < _token_cache["expires_at"]:
-        return _token_cache["token"]
 
-    try:
-        response = requests.post(
-            "https://portal.gps.id/backend/seen/public/login",
-            json={
-                "username": gps_config['username'],
-                "password": gps_config['password']
-            },
-            headers={"Content-Type": "application/json"})
-        response.raise_for_status()
-        token = response.json().get("message", {}).get("data", {}).get("token")
-        if token:
-            _token_cache["token"] = token
-            _token_cache["expires_at"] = now + (55 * 60)
+GPS_BASE_URL = os.getenv("GPS_BASE_URL", "https://portal.gps.id/backend/seen/public")
+GPS_RATE_PER_SEC = float(os.getenv("GPS_RATE_PER_SEC", 1))
+GPS_RATE_BURST = int(os.getenv("GPS_RATE_BURST", 3))
+GPS_FETCH_WORKERS = int(os.getenv("GPS_FETCH_WORKERS", 4))
+
+gps_limiter = TokenBucket(GPS_RATE_PER_SEC, GPS_RATE_BURST)
+
+
+class GPSError(Exception):
+    pass
+
+
+class GPSClient:
+    """Satu-satunya pintu ke API GPS.id.
+
+    Memegang session keep-alive (connection pool), token login bersama,
+    retry dengan exponential backoff + jitter, dan timeout per endpoint.
+    """
+
+    # (connect, read) timeout per endpoint
+    TIMEOUTS = {
+        "login": (5, 15),
+        "vehicle": (5, 15),
+        "history": (5, 30),
+    }
+    RETRY_STATUS = (500, 502, 503, 504)
+    TOKEN_TTL = 55 * 60
+
+    def __init__(self, base_url, username, password, limiter,
+                 pool_size=10, max_retries=4, max_throttled=10, backoff_base=1, backoff_cap=30):
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.max_throttled = max_throttled
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+    # ---------- token ----------
+    def token(self):
+        """Token yang masih berlaku; login hanya kalau belum ada / sudah kedaluwarsa"""
+        if self._token and time.time() < self._token_expires_at:
+            return self._token
+        with self._token_lock:
+            # thread lain mungkin sudah login selagi kita menunggu lock
+            if self._token and time.time() < self._token_expires_at:
+                return self._token
+            try:
+                res = self.request("POST", "/login", "login", auth=False, json={
+                    "username": self.username,
+                    "password": self.password
+                })
+                res.raise_for_status()
+                token = res.json().get("message", {}).get("data", {}).get("token")
+            except (requests.RequestException, GPSError) as e:
+                logging.error(f"❌ Error getting token: {e}")
+                return None
+            if token:
+                self._token = token
+                self._token_expires_at = time.time() + self.TOKEN_TTL
             return token
-    except requests.RequestException as e:
-        print(f"Error getting token: {e}")
-        return None
 
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0
 
-cached_token = None
-token_expiry = None
+    # ---------- request ----------
+    def _backoff(self, attempt):
+        # full jitter: acak 0..min(cap, base * 2^attempt)
+        time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt))))
 
+    def request(self, method, path, endpoint, auth=True, **kwargs):
+        kwargs.setdefault("timeout", self.TIMEOUTS.get(endpoint, (5, 30)))
+        attempt = throttled = 0
+        reauthed = False
 
-def get_token_cached():
-    global cached_token, token_expiry
-    now = datetime.utcnow()
-    if cached_token and token_expiry and now < token_expiry:
-        return cached_token
-    # Ambil token baru
-    token = get_token()
-    if token:
-        cached_token = token
-        token_expiry = now + timedelta(minutes=10)
-    return token
+        while True:
+            headers = {}
+            if auth:
+                token = self.token()
+                if not token:
+                    raise GPSError("Gagal mendapatkan token dari GPS.id")
+                headers["Authorization"] = f"Bearer {token}"
+
+            waited = self.limiter.acquire()
+            if waited:
+                metrics.inc("gps_ratelimit_wait_seconds_total", waited, endpoint=endpoint)
+            started = time.perf_counter()
+            try:
+                res = self.session.request(method, self.base_url + path, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc("gps_requests_total", endpoint=endpoint, status="error")
+                if attempt >= self.max_retries:
+                    raise
+                metrics.inc("gps_retries_total", endpoint=endpoint, reason="connection")
+                logging.warning(f"⚠️ {endpoint}: {e} → retry {attempt + 1}/{self.max_retries}")
+                self._backoff(attempt)
+                attempt += 1
+                continue
+            metrics.observe("gps_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+            metrics.inc("gps_requests_total", endpoint=endpoint, status=res.status_code)
+
+            if res.status_code == 429:
+                wait_time = parse_retry_after(res.headers.get("Retry-After"))
+                self.limiter.penalize(wait_time)
+                metrics.inc("gps_throttled_total", endpoint=endpoint)
+                metrics.inc("gps_retry_after_seconds_total", wait_time, endpoint=endpoint)
+                if throttled >= self.max_throttled:
+                    return res
+                logging.warning(f"⚠️ Rate limit! tunggu {wait_time} detik...")
+                throttled += 1
+                continue
 
-# =========================== GPS API FUNCTIONS ===========================
-def get_vehicle_data(token):
-    try:
-        res = requests.get("https://portal.gps.id/backend/seen/public/vehicle",
-                           headers={"Authorization": f"Bearer {token}"})
+            if res.status_code == 401 and auth and not reauthed:
+                # token ditolak (mis. login dari tempat lain) -> login ulang sekali
+                metrics.inc("gps_retries_total", endpoint=endpoint, reason="reauth")
+                self.invalidate_token()
+                reauthed = True
+                continue
+
+            if res.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                metrics.inc("gps_retries_total", endpoint=endpoint, reason=str(res.status_code))
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            self.limiter.success()
+            return res
+
+    # ---------- endpoint ----------
+    def vehicles(self):
+        res = self.request("GET", "/vehicle", "vehicle")
         res.raise_for_status()
         return res.json().get("message", {}).get("data", [])
-    except requests.RequestException as e:
-        print(f"Error getting vehicle data: {e}")
-        return []
 
+    def history_page(self, imei, start, end, page, per_page):
+        """Satu halaman /report/history. Return (data, last_page)"""
+        res = self.request("GET", "/report/history", "history", params={
+            "device": imei,
+            "start": start,
+            "end": end,
+            "page": page,
+            "per_page": per_page
+        })
+        res.raise_for_status()
+        message = res.json().get("message", {})
+        return message.get("data", []), message.get("last_page", page)
+
+
+gps_client = GPSClient(GPS_BASE_URL, gps_config['username'], gps_config['password'],
+                       gps_limiter, pool_size=GPS_FETCH_WORKERS * 2)
 
-LAST_REQUEST = 0
-RATE_LIMIT_DELAY = 2  # jeda minimal 2 detik antar request
 
-def safe_request(*args, **kwargs):
-    global LAST_REQUEST
-    now = time.time()
-    if now - LAST_REQUEST < RATE_LIMIT_DELAY:
-        time.sleep(RATE_LIMIT_DELAY - (now - LAST_REQUEST))
-    res = requests.get(*args, **kwargs)
-    LAST_REQUEST = time.time()
-    return res
+def reduce_point(d):
+    """Ambil hanya field yang dipakai dari titik mentah API"""
+    return {f: d.get(f) for f in HISTORY_FIELDS}
 
-def get_history_data(token, imei, start_date, end_date):
-    all_data = []
+
+def stream_history_api(imei, start_date, end_date, status):
+    """Generator: tiap halaman API GPS.id -> (tanggal chunk, titik yang sudah
+    diringkas, chunk_selesai). chunk_selesai True di halaman terakhir chunk.
+
+    Chunk tanggal yang gagal diambil dicatat di status["failed_days"] dan
+    tidak pernah ditandai selesai.
+    """
     per_page = 10000
 
     start_dt = datetime.strptime(start_date, "%Y-%m-%d")
@@ -195,81 +815,587 @@ def get_history_data(token, imei, start_date, end_date):
     current_start = start_dt
     while current_start <= end_dt:
         current_end = min(current_start + timedelta(days=3), end_dt)
+        chunk_days = date_range(current_start.strftime("%Y-%m-%d"), current_end.strftime("%Y-%m-%d"))
         page = 1
-        chunk_data = []
+        chunk_count = 0
 
         while True:
             try:
-                res = safe_request(
-                    "https://portal.gps.id/backend/seen/public/report/history",
-                    headers={"Authorization": f"Bearer {token}"},
-                    params={
-                        "device": imei,
-                        "start": current_start.strftime("%Y-%m-%d 00:00:00"),
-                        "end": current_end.strftime("%Y-%m-%d 23:59:59"),
-                        "page": page,
-                        "per_page": per_page
-                    },
-                    timeout=30
+                data, last_page = gps_client.history_page(
+                    imei,
+                    current_start.strftime("%Y-%m-%d 00:00:00"),
+                    current_end.strftime("%Y-%m-%d 23:59:59"),
+                    page, per_page
+                )
+            except Exception as e:
+                logging.error(
+                    f"❌ Error page {page} ({current_start.date()} - {current_end.date()}): {e}"
                 )
+                # data chunk ini tidak lengkap -> jangan ditandai selesai di store
+                status["failed_days"].update(chunk_days)
+                break
 
-                # Kalau API balas 429 -> tunggu lalu ulangi request
-                if res.status_code == 429:
-                    wait_time = int(res.headers.get("Retry-After", 60))
-                    print(f"⚠️ Rate limit! tunggu {wait_time} detik...")
-                    time.sleep(wait_time)
+            chunk_count += len(data)
+            done = not data or page >= last_page
+            yield chunk_days, [reduce_point(d) for d in data if d.get("time")], done
+
+            if done:
+                break
+            page += 1
+
+        logging.info(f"📆 {imei} {current_start.date()} - {current_end.date()} → {chunk_count} data")
+
+        current_start = current_end + timedelta(days=1)
+
+# =========================== HISTORY INGEST ===========================
+# Fetch API -> store per hari (telemetry.py). Hari yang sudah lengkap di store
+# tidak pernah diambil lagi; fetch yang tumpang tindih digabung (SingleFlight).
+def ingest_history(imei, start_date, end_date):
+    """Stream history dari API ke store, chunk per chunk (maks 4 hari).
+
+    Titik hari yang sudah tutup ditahan sampai chunk-nya selesai, lalu
+    penggantian titik + tanda lengkap di history_days ditulis dalam satu
+    transaksi: chunk yang gagal di tengah jalan tidak mengubah store sama
+    sekali. Titik hari yang masih terbuka (hari ini) hanya di memori.
+    Return {tanggal: [titik]} untuk hari yang masih terbuka.
+    """
+    today = local_today()
+    open_points = defaultdict(list)
+    status = {"failed_days": set()}
+    closed, rows, fetched = [], [], 0
+
+    conn = history_conn()
+    try:
+        for chunk_days, page, done in stream_history_api(imei, start_date, end_date, status):
+            fetched += len(page)
+            for p in page:
+                day = p["time"][:10]
+                if day not in chunk_days:
                     continue
+                if day >= today:
+                    open_points[day].append(p)
+                    continue
+                rows.append((imei, day) + tuple(p[f] for f in HISTORY_FIELDS))
+            if done:
+                closed += save_history_chunk(conn, imei, [d for d in chunk_days if d < today], rows)
+                rows = []
+    finally:
+        conn.close()
+    metrics.inc("history_points_fetched_total", fetched, imei=imei)
+    # trips & index spasial bisa disusulkan saat dibaca, ingest tetap sukses
+    try:
+        segment_stored_days(imei, closed)
+    except Exception:
+        logging.exception(f"🚨 Segmentasi trip {imei} {start_date} → {end_date} gagal")
+    try:
+        index_stored_days(imei, closed)
+    except Exception:
+        logging.exception(f"🚨 Index spasial {imei} {start_date} → {end_date} gagal")
+
+    for pts in open_points.values():
+        pts.sort(key=lambda x: x["time"])
+    return open_points
+
+
+class SingleFlight:
+    """Satu pekerjaan per key dalam satu waktu; pemanggil lain dengan key yang
+    sama menunggu dan ikut memakai hasilnya (request coalescing)."""
+
+    def __init__(self):
+        self.inflight = {}  # key -> Future
+        self.lock = threading.Lock()
+        self.started = self.coalesced = 0
+
+    def claim(self, keys):
+        """Return (key yang harus dikerjakan sendiri, {key: Future milik pemanggil lain})"""
+        owned, waiting = [], {}
+        with self.lock:
+            for key in keys:
+                if key in self.inflight:
+                    waiting[key] = self.inflight[key]
+                else:
+                    self.inflight[key] = Future()
+                    owned.append(key)
+            self.started += len(owned)
+            self.coalesced += len(waiting)
+        return owned, waiting
+
+    def resolve(self, results, error=None):
+        """results: {key: hasil}. Kalau error, semua yang menunggu ikut dapat exception"""
+        with self.lock:
+            futures = {key: self.inflight.pop(key) for key in results}
+        for key, fut in futures.items():
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(results[key])
+
+    def stats(self):
+        with self.lock:
+            return {"inflight": len(self.inflight), "started": self.started, "coalesced": self.coalesced}
+
+
+# fetch history dikunci per (imei, tanggal): request yang tumpang tindih
+# (dashboard, maps, /historical, detail) menunggu fetch yang sedang jalan
+history_flight = SingleFlight()
+
+
+def ingest_missing_days(imei, start_date, end_date):
+    """Ambil dari API hanya hari yang belum lengkap di store. Return titik hari terbuka"""
+    days = date_range(start_date, end_date)
+    if not days:
+        return {}
+    stored = get_stored_days(imei, days[0], days[-1])
+    missing = [d for d in days if d not in stored]
+    if stored:
+        logging.info(f"💾 {imei}: {len(stored)}/{len(days)} hari dari store lokal")
+    if not missing:
+        return {}
+
+    owned, waiting = history_flight.claim([(imei, d) for d in missing])
+    open_points = {}
+    if owned:
+        results = {key: [] for key in owned}
+        # bisa saja baru selesai diisi pemilik sebelumnya antara cek di atas dan claim
+        done = get_stored_days(imei, owned[0][1], owned[-1][1])
+        try:
+            for run_start, run_end in contiguous_runs([d for _, d in owned if d not in done]):
+                for day, pts in ingest_history(imei, run_start, run_end).items():
+                    results[(imei, day)] = pts
+        except Exception as e:
+            history_flight.resolve(results, error=e)
+            raise
+        history_flight.resolve(results)
+        open_points.update({day: pts for (_, day), pts in results.items() if pts})
+
+    if waiting:
+        logging.info(f"⏳ {imei}: {len(waiting)} hari sedang diambil request lain, menunggu")
+        for (_, day), fut in waiting.items():
+            pts = fut.result()
+            if pts:
+                open_points[day] = pts
+    return open_points
+
+
+def get_history_data(imei, start_date, end_date, open_points=None):
+    """History per hari: hari yang sudah tutup dari store lokal, sisanya dari API
+
+    open_points: hasil ingest_missing_days kalau pemanggil sudah mengambilnya.
+    """
+    if open_points is None:
+        open_points = ingest_missing_days(imei, start_date, end_date)
+    all_data = load_stored_history(imei, start_date, end_date)
+    for day in sorted(open_points):
+        all_data.extend(open_points[day])
+    return all_data
 
-                res.raise_for_status()
-                json_data = res.json()
-                message = json_data.get("message", {})
-                data = message.get("data", [])
+# =========================== ROLLUP HARIAN ===========================
+# Tabel `historical` di historical.db menyimpan rekap per (imei, tanggal).
+# Rekap hari yang sudah tutup dihitung sekali, request berikutnya cukup query SQL.
+HISTORICAL_DB = "historical.db"
+ROLLUP_EXTRA_COLUMNS = {
+    "speed_sum": "REAL DEFAULT 0",
+    "speed_count": "INTEGER DEFAULT 0",
+    "point_count": "INTEGER DEFAULT 0",
+    "closed": "INTEGER DEFAULT 0"
+}
 
-                if not data:
-                    break
+_historical_db_ready = False
 
-                chunk_data.extend(data)
-                all_data.extend(data)
 
-                if page >= message.get("last_page", page):
-                    break
-                page += 1
+def init_historical_db():
+    global _historical_db_ready
+    with _db_init_lock:
+        _init_historical_db()
+    _historical_db_ready = True
 
-                # jeda kecil antar halaman biar ga overload
-                time.sleep(1)
 
-            except Exception as e:
-                print(
-                    f"❌ Error page {page} ({current_start.date()} - {current_end.date()}): {e}"
-                )
-                # kasih jeda sebelum lanjut biar ga langsung fail total
-                time.sleep(5)
-                break
+def _init_historical_db():
+    conn = sqlite3.connect(HISTORICAL_DB)
+    c = conn.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS historical (
+            imei TEXT,
+            plate TEXT,
+            date TEXT,
+            mileage REAL,
+            fuel_used REAL,
+            avg_speed REAL,
+            PRIMARY KEY (imei, date)
+        )
+    """)
+    existing = {r[1] for r in c.execute("PRAGMA table_info(historical)")}
+    for col, col_type in ROLLUP_EXTRA_COLUMNS.items():
+        if col not in existing:
+            c.execute(f"ALTER TABLE historical ADD COLUMN {col} {col_type}")
+    conn.commit()
+    conn.close()
 
-        print(f"  📆 {current_start.date()} - {current_end.date()} → {len(chunk_data)} data")
 
-        # jeda antar range tanggal biar lebih aman
-        time.sleep(2)
+def historical_conn():
+    if not _historical_db_ready:
+        init_historical_db()
+    return sqlite3.connect(HISTORICAL_DB, timeout=30)
 
-        current_start = current_end + timedelta(days=1)
 
-    return all_data
+def upsert_rollups(rows):
+    conn = historical_conn()
+    with conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO historical
+                (imei, plate, date, mileage, fuel_used, avg_speed,
+                 speed_sum, speed_count, point_count, closed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+    conn.close()
+
+
+def ensure_rollups(imei, plate, start_date, end_date, fuel_type="Solar"):
+    """Pastikan rekap harian untuk periode ini ada. Return jumlah hari yang dihitung ulang"""
+    today = local_today()
+    days = [d for d in date_range(start_date, end_date) if d <= today]
+    if not days:
+        return 0
+
+    conn = historical_conn()
+    c = conn.cursor()
+    c.execute("SELECT date FROM historical WHERE imei=? AND date BETWEEN ? AND ? AND closed=1",
+              (imei, days[0], days[-1]))
+    closed = {r[0] for r in c.fetchall()}
+    conn.close()
+
+    stale = [d for d in days if d not in closed]
+    if not stale:
+        return 0
+
+    eff = EFFICIENCY_BY_FUEL.get(fuel_type, 15)
+    for run_start, run_end in contiguous_runs(stale):
+        open_points = ingest_missing_days(imei, run_start, run_end)
+        # hanya hari yang datanya lengkap di store yang boleh dianggap final
+        complete = get_stored_days(imei, run_start, run_end)
+
+        grouped = {}
+        for day, cols in iter_day_columns(imei, run_start, run_end, open_points):
+            grouped.update(aggregate_daily(cols))
+
+        rows = []
+        for d in date_range(run_start, run_end):
+            agg = grouped.get((imei, d))
+            mileage_km = agg["mileage_km"] if agg else 0
+            speed_sum = agg["speed_sum"] if agg else 0
+            speed_count = agg["speed_count"] if agg else 0
+            rows.append((
+                imei, plate, d,
+                mileage_km,
+                mileage_km / eff,
+                speed_sum / speed_count if speed_count else 0,
+                speed_sum, speed_count,
+                agg["point_count"] if agg else 0,
+                1 if d in complete else 0
+            ))
+        upsert_rollups(rows)
+        metrics.inc("rollup_points_total", sum(r[8] for r in rows), imei=imei)
+
+    return len(stale)
+
+
+def query_daily_rollups(imeis, start_date, end_date):
+    """{imei: {tanggal: row}} untuk beberapa kendaraan sekaligus"""
+    if not imeis:
+        return {}
+    placeholders = ",".join("?" * len(imeis))
+    conn = historical_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT imei, date, mileage, avg_speed, speed_count, point_count, closed
+        FROM historical
+        WHERE imei IN ({placeholders}) AND date BETWEEN ? AND ?
+        ORDER BY imei, date
+    """, (*imeis, start_date, end_date))
+    rows = c.fetchall()
+    conn.close()
+
+    result = defaultdict(dict)
+    for imei, date_str, mileage, avg_speed, speed_count, point_count, closed in rows:
+        result[imei][date_str] = {
+            "mileage_km": mileage or 0,
+            "avg_speed": avg_speed or 0,
+            "speed_count": speed_count or 0,
+            "point_count": point_count or 0,
+            "closed": bool(closed)
+        }
+    return result
+
+
+# =========================== FETCH SCHEDULER ===========================
+# Download history beberapa kendaraan sekaligus. Kecepatan total tetap diatur
+# oleh gps_limiter, jadi jumlah worker hanya menentukan berapa yang antre.
+_fetch_pool = ThreadPoolExecutor(max_workers=GPS_FETCH_WORKERS, thread_name_prefix="gps-fetch")
+
+
+def run_parallel(fn, jobs, on_done=None):
+    """Jalankan fn(*args) untuk tiap job. Return hasil sesuai urutan job (Exception kalau gagal)
+
+    on_done(job, hasil) dipanggil tiap kali satu job selesai (untuk progress).
+    """
+    if len(jobs) == 1:
+        # satu job langsung jalan di thread pemanggil (aman juga kalau dipanggil dari pool)
+        try:
+            results = [fn(*jobs[0])]
+        except Exception as e:
+            results = [e]
+        if on_done:
+            on_done(jobs[0], results[0])
+        return results
+
+    futures = {_fetch_pool.submit(fn, *args): i for i, args in enumerate(jobs)}
+    results = [None] * len(jobs)
+    for fut in as_completed(futures):
+        i = futures[fut]
+        try:
+            results[i] = fut.result()
+        except Exception as e:
+            results[i] = e
+        if on_done:
+            on_done(jobs[i], results[i])
+    return results
+
+# =========================== CACHE ===========================
+# Cache hasil rekap di memori: dibatasi jumlah entry & ukuran (byte), TTL
+# beda untuk periode yang sudah tutup dan yang masih berjalan, aman dipakai
+# banyak thread. Kalau CACHE_DB di-set, entry juga disimpan di SQLite supaya
+# bisa dipakai bersama beberapa worker gunicorn (lewat SQLitePool; set_many
+# menulis banyak entry dalam satu transaksi).
+CACHE_DB = os.getenv("CACHE_DB", "")
+CACHE_TTL_CLOSED = int(os.getenv("CACHE_TTL_CLOSED", 6 * 3600))
+CACHE_TTL_OPEN = int(os.getenv("CACHE_TTL_OPEN", 120))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+class TTLCache:
+
+    def __init__(self, name, max_entries=1024, max_bytes=CACHE_MAX_BYTES,
+                 ttl_closed=CACHE_TTL_CLOSED, ttl_open=CACHE_TTL_OPEN, disk_path=CACHE_DB):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_closed = ttl_closed
+        self.ttl_open = ttl_open
+        self.disk = SQLitePool(disk_path) if disk_path else None
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expired = 0
+        self.lock = threading.Lock()
+        self._disk_writes = 0
+        if self.disk:
+            self.disk.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    name TEXT,
+                    key TEXT,
+                    value BLOB,
+                    expires_at REAL,
+                    PRIMARY KEY (name, key)
+                )
+            """)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                self._remove(key)
+                self.expired += 1
+
+        row = self.disk.query_one(
+            "SELECT value FROM cache_entries WHERE name=? AND key=? AND expires_at > ?",
+            (self.name, key, now)) if self.disk else None
+        blob = row[0] if row else None
+        with self.lock:
+            if blob is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        value, expires_at = pickle.loads(blob)
+        self._put(key, value, len(blob), expires_at)
+        return value
+
+    def set(self, key, value, is_open=False):
+        self.set_many([(key, value, is_open)])
+
+    def set_many(self, items):
+        """items: [(key, value, is_open)]; ke disk ditulis dalam satu transaksi"""
+        now = time.time()
+        rows = []
+        for key, value, is_open in items:
+            expires_at = now + (self.ttl_open if is_open else self.ttl_closed)
+            blob = pickle.dumps((value, expires_at), protocol=pickle.HIGHEST_PROTOCOL)
+            self._put(key, value, len(blob), expires_at)
+            rows.append((self.name, key, blob, expires_at))
+        if not self.disk or not rows:
+            return
+        with self.lock:
+            prune = self._disk_writes // 100 != (self._disk_writes + len(rows)) // 100
+            self._disk_writes += len(rows)
+        with self.disk.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO cache_entries (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                             rows)
+            if prune:
+                conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.disk:
+            self.disk.execute("DELETE FROM cache_entries WHERE name=?", (self.name,))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0,
+                "evictions": self.evictions,
+                "expired": self.expired
+            }
+
+    def _put(self, key, value, size, expires_at):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires_at)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+
+# rekap per (imei, tanggal); periode apa pun disusun dari potongan harian ini
+daily_cache = TTLCache("daily", max_entries=100_000)
+
+
+metrics.describe("cache_hits_total", "counter", "Cache hit per cache")
+metrics.describe("cache_misses_total", "counter", "Cache miss per cache")
+metrics.describe("cache_hit_ratio", "gauge", "Rasio hit / (hit + miss) per cache")
+metrics.describe("cache_entries", "gauge", "Jumlah entry di memori per cache")
+metrics.describe("cache_bytes", "gauge", "Ukuran entry di memori (byte, pickle) per cache")
+metrics.describe("cache_evictions_total", "counter", "Entry yang dibuang karena batas jumlah/ukuran")
+metrics.describe("singleflight_shared_total", "counter", "Fetch history yang menumpang fetch request lain")
+
+
+@metrics.collector
+def cache_metrics():
+    for cache in (daily_cache,):
+        s = cache.stats()
+        yield "cache_hits_total", {"cache": cache.name}, s["hits"]
+        yield "cache_misses_total", {"cache": cache.name}, s["misses"]
+        yield "cache_hit_ratio", {"cache": cache.name}, s["hit_ratio"]
+        yield "cache_entries", {"cache": cache.name}, s["entries"]
+        yield "cache_bytes", {"cache": cache.name}, s["bytes"]
+        yield "cache_evictions_total", {"cache": cache.name}, s["evictions"]
+    yield "singleflight_shared_total", {}, history_flight.stats()["coalesced"]
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    stats = {c.name: c.stats() for c in (daily_cache,)}
+    stats["history_singleflight"] = history_flight.stats()
+    return jsonify(stats)
+
+
+def get_daily_rollups(vehicles, start_date, end_date, on_progress=None, on_error=None):
+    """vehicles: [(imei, plate, fuel_type)]. Return {imei: {tanggal: row}}
+
+    Hari yang sudah ada di daily_cache tidak disentuh lagi; hanya hari yang
+    kurang yang direkap (paralel per kendaraan) lalu dibaca dari historical.db.
+    on_progress(imei, jumlah_hari) dipanggil tiap ada hari yang selesai,
+    on_error(imei, pesan) sekali per kendaraan yang punya hari lewat yang
+    datanya belum lengkap (fetch API gagal, closed=0) atau rekapnya error.
+    """
+    today = local_today()
+    days = date_range(start_date, end_date)
+    result = {imei: {} for imei, _, _ in vehicles}
+    missing = {}
+    for imei, _, _ in vehicles:
+        for d in days:
+            row = daily_cache.get(f"{imei}_{d}")
+            # hari lewat yang belum lengkap dicoba lagi, jangan dipakai dari cache
+            if row is None or (d < today and not row["closed"]):
+                missing.setdefault(imei, []).append(d)
+            else:
+                result[imei][d] = row
+        if on_progress and result[imei]:
+            on_progress(imei, len(result[imei]))
+
+    errors = {}
+    if missing:
+        fetch_missing_rollups(vehicles, missing, result, on_progress, errors)
+
+    if on_error:
+        for imei, _, _ in vehicles:
+            failed = [d for d in days if d < today and not result[imei].get(d, {}).get("closed")]
+            if failed:
+                message = f"data API belum lengkap untuk {len(failed)} hari ({failed[0]} → {failed[-1]})"
+                on_error(imei, f"{message}: {errors[imei]}" if imei in errors else message)
+    return result
+
+
+def fetch_missing_rollups(vehicles, missing, result, on_progress, errors):
+    """Rekap hari di `missing` ({imei: [tanggal]}) lalu isi `result` & daily_cache"""
+    jobs = [
+        (imei, plate, run_start, run_end, fuel_type)
+        for imei, plate, fuel_type in vehicles
+        for run_start, run_end in contiguous_runs(missing.get(imei, []))
+    ]
+
+    def job_done(job, res):
+        if isinstance(res, Exception):
+            logging.error(f"❌ Gagal rekap {job[1]} {job[2]} → {job[3]} → {res}")
+            errors[job[0]] = str(res)
+        if on_progress:
+            on_progress(job[0], len(date_range(job[2], job[3])))
+
+    run_parallel(ensure_rollups, jobs, on_done=job_done)
+
+    lo = min(ds[0] for ds in missing.values())
+    hi = max(ds[-1] for ds in missing.values())
+    fetched = query_daily_rollups(list(missing), lo, hi)
+    cached = []
+    for imei, ds in missing.items():
+        for d in ds:
+            row = fetched.get(imei, {}).get(d)
+            if row is None:
+                continue  # hari di masa depan / gagal direkap
+            result[imei][d] = row
+            cached.append((f"{imei}_{d}", row, not row["closed"]))
+    daily_cache.set_many(cached)
 
 # =========================== HELPER FUNCTION ===========================
 def get_active_vehicles():
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT imei, plate, COALESCE(custom_name, device_name) as device_name, fuel_type
-            FROM vehicles_status
-            WHERE status='Aktif'
-        """)
-        rows = c.fetchall()
-    if not rows:
-        return pd.DataFrame(columns=["imei", "plate", "device_name", "fuel_type"])
-    return pd.DataFrame(rows, columns=["imei", "plate", "device_name", "fuel_type"]).sort_values(by="plate").reset_index(drop=True)
+    """[{imei, plate, device_name, fuel_type}] kendaraan Aktif, urut plate"""
+    rows = vehicles_db.query("""
+        SELECT imei, plate, COALESCE(custom_name, device_name) as device_name, fuel_type
+        FROM vehicles_status
+        WHERE status='Aktif'
+        ORDER BY plate
+    """)
+    return [dict(zip(("imei", "plate", "device_name", "fuel_type"), r)) for r in rows]
 
 def load_active_vehicles():
+    import pandas as pd  # berat: hanya di-load kalau halaman maps dipakai
     if not os.path.exists(EXCEL_FILE):
         raise FileNotFoundError("File Excel tidak ditemukan.")
     df = pd.read_excel(EXCEL_FILE)
@@ -302,15 +1428,75 @@ def hitung_emisi(volume_liter, fuel_type="diesel"):
         "Total_CO2e_ton": total_co2e / 1000
     }
 
+
+# kg gas per liter untuk tiap kategori BBM (urutan = EMISSION_CATEGORIES), dihitung sekali
+EMISSION_CATEGORIES = tuple(FUEL_DEFAULTS)
+EMISSION_FACTORS = np.array([
+    [f["density"] * f["ncv"] / 1_000_000 * f[ef] for ef in ("ef_co2", "ef_ch4", "ef_n2o")]
+    for f in FUEL_DEFAULTS.values()
+])
+EMISSION_COLUMNS = ("volume_liter", "CO2_kg", "CH4_kg", "N2O_kg", "CH4_CO2e", "N2O_CO2e",
+                    "Total_CO2e_kg", "Total_CO2e_ton")
+
+
+def emission_category_codes(fuel_type):
+    """Jenis BBM ('Solar', 'Pertalite', ...) atau kategori ('diesel', ...) -> indeks EMISSION_CATEGORIES"""
+    names, inverse = np.unique(np.asarray(fuel_type).astype(str), return_inverse=True)
+    lookup = np.array([
+        EMISSION_CATEGORIES.index(n if n in FUEL_DEFAULTS else FUEL_MAPPING.get(n, "diesel"))
+        for n in names
+    ], dtype=int)
+    return lookup[inverse.ravel()]
+
+
+def group_totals(keys, cols):
+    """{key: {kolom: total}} untuk kolom NumPy, digrup dengan np.unique + bincount"""
+    names, inverse = np.unique(np.asarray(keys).astype(str), return_inverse=True)
+    inverse = inverse.ravel()
+    sums = {c: np.bincount(inverse, weights=cols[c], minlength=len(names)) for c in EMISSION_COLUMNS}
+    return {str(name): {c: float(sums[c][i]) for c in EMISSION_COLUMNS} for i, name in enumerate(names)}
+
+
+def hitung_emisi_batch(volume_liter, fuel_type="diesel", group_by=None):
+    """Versi vektor hitung_emisi untuk banyak baris sekaligus (mis. per kendaraan per hari).
+
+    volume_liter: array liter, atau DataFrame dengan kolom volume_liter,
+    fuel_type dan (opsional) date. fuel_type: satu nilai atau array sejajar,
+    boleh jenis BBM ('Solar') maupun kategori ('diesel'). group_by: kunci
+    grup sejajar (tanggal, bulan, plate, ...).
+
+    Return {"rows": kolom NumPy seperti hitung_emisi, "by_fuel": total per
+    kategori, "by_group": total per grup (kalau group_by diisi), "total"}.
+    """
+    if hasattr(volume_liter, "columns"):
+        df = volume_liter
+        fuel_type = df["fuel_type"].to_numpy()
+        if group_by is None and "date" in df.columns:
+            group_by = df["date"].to_numpy()
+        volume_liter = df["volume_liter"].to_numpy()
+
+    volume = np.asarray(volume_liter, dtype=float).ravel()
+    codes = emission_category_codes(np.broadcast_to(np.asarray(fuel_type, dtype=object), volume.shape))
+    gas = volume[:, None] * EMISSION_FACTORS[codes]
+
+    cols = {"volume_liter": volume, "CO2_kg": gas[:, 0], "CH4_kg": gas[:, 1], "N2O_kg": gas[:, 2]}
+    cols["CH4_CO2e"] = cols["CH4_kg"] * GWP_CH4
+    cols["N2O_CO2e"] = cols["N2O_kg"] * GWP_N2O
+    cols["Total_CO2e_kg"] = cols["CO2_kg"] + cols["CH4_CO2e"] + cols["N2O_CO2e"]
+    cols["Total_CO2e_ton"] = cols["Total_CO2e_kg"] / 1000
+
+    return {
+        "rows": cols,
+        "by_fuel": group_totals(np.array(EMISSION_CATEGORIES)[codes], cols),
+        "by_group": group_totals(group_by, cols) if group_by is not None else None,
+        "total": {c: float(cols[c].sum()) for c in EMISSION_COLUMNS},
+    }
+
 #==================== DASHBOARD ======================================
 
 @app.route('/', methods=['GET'])
 def dashboard():
     try:
-        token = get_token_cached()
-        if not token:
-            return "Gagal mendapatkan token", 500
-
         # Ambil filter dari query
         search_plate = request.args.get('plate', '') or ''
         start_time = request.args.get('start_time')
@@ -318,61 +1504,43 @@ def dashboard():
 
         # Default tanggal kemarin
         if not start_time or not end_time:
-            yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-            start_time = end_time = yesterday
+            start_time = end_time = local_yesterday()
 
         start_dt = datetime.strptime(start_time, '%Y-%m-%d')
         end_dt = datetime.strptime(end_time, '%Y-%m-%d')
         delta_days = (end_dt - start_dt).days + 1
 
         # Ambil mapping plate -> imei & fuel_type dari DB
-        df_active = get_active_vehicles()
-        df_active['imei'] = df_active['imei'].astype(str)
-        plate_to_imei = dict(zip(df_active['plate'], df_active['imei']))
-        plate_to_fueltype = dict(zip(df_active['plate'], df_active['fuel_type']))
+        active = get_active_vehicles()
+        plate_to_imei = {v['plate']: str(v['imei']) for v in active}
+        plate_to_fueltype = {v['plate']: v['fuel_type'] for v in active}
         all_plates = list(plate_to_imei.keys())
         target_plates = [search_plate] if search_plate else all_plates
 
         # Siapkan summary & chart
         summary_data = []
-        total_diesel = total_gasoline = total_emisi_gasoline = total_emisi_diesel = 0
 
         chart_labels = [(start_dt + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(delta_days)]
         chart_datasets = []
 
+        daily_rollups = get_daily_rollups(
+            [(plate_to_imei[plate], plate, plate_to_fueltype.get(plate) or "None")
+             for plate in target_plates if plate_to_imei.get(plate)],
+            start_time, end_time
+        )
+        mark_stage("fetch")
+
         for plate in target_plates:
             imei = plate_to_imei.get(plate)
             if not imei:
                 continue
 
-            data = get_history_data(token, imei, start_time, end_time)
-            if not data:
-                daily_mileage = [0] * delta_days
-            else:
-                # hitung mileage per hari
-                daily_result = defaultdict(lambda: {"mileage_km": 0, "prev_odo": None})
-                data = sorted(
-                    [d for d in data if d.get("time") and d.get("mileage") is not None],
-                    key=lambda x: x['time']
-                )
-                prev_mileage = None
-                for d in data:
-                    odo = d.get("mileage", 0) or 0
-                    ts = d.get("time")
-                    if prev_mileage is not None and odo > prev_mileage:
-                        delta_km = (odo - prev_mileage) / 1000
-                    else:
-                        delta_km = 0
-                    prev_mileage = odo
-                    if ts:
-                        date_str = ts[:10]
-                        if 0 < delta_km < 500:
-                            daily_result[date_str]["mileage_km"] += delta_km
-
-                daily_mileage = [
-                    round(daily_result[d]["mileage_km"], 2) if d in daily_result else 0
-                    for d in chart_labels
-                ]
+            # mileage per hari dari tabel rekap
+            days = daily_rollups.get(imei, {})
+            daily_mileage = [
+                round(days[d]["mileage_km"], 2) if d in days else 0
+                for d in chart_labels
+            ]
 
             # total mileage
             total_mileage = sum(daily_mileage)
@@ -382,22 +1550,8 @@ def dashboard():
             efficiency = EFFICIENCY_BY_FUEL.get(fuel_type_db, 15)
             fuel_used = round(total_mileage / efficiency, 2)
 
-            # kategori untuk emission factor
-            fuel_category = FUEL_MAPPING.get(fuel_type_db, "diesel")
-            emisi = hitung_emisi(fuel_used, fuel_type=fuel_category)
-
-            # total emisi global
-            if fuel_category == "gasoline":
-                total_gasoline += fuel_used
-                total_emisi_gasoline += emisi["Total_CO2e_ton"]
-            else:
-                total_diesel += fuel_used
-                total_emisi_diesel += emisi["Total_CO2e_ton"]
-
             # avg speed
-            total_speed = sum([d.get('speed', 0) or 0 for d in data]) if data else 0
-            count_speed = len([d for d in data if d.get('speed') is not None]) if data else 0
-            avg_speed = round(total_speed / count_speed, 2) if count_speed else 0
+            avg_speed = round(summarize_days(days)["avg_speed"], 2)
 
             # simpan ke summary
             summary_data.append({
@@ -406,9 +1560,7 @@ def dashboard():
                 "fuel_consumption": fuel_used,
                 "avg_speed": avg_speed,
                 "fuel_type": fuel_type_db,
-                "daily_mileage": daily_mileage,
-                "emisi_total_ton": round(emisi["Total_CO2e_ton"], 2),
-                "emisi_total_kg": round(emisi["Total_CO2e_kg"], 2)
+                "daily_mileage": daily_mileage
             })
 
             # chart dataset
@@ -417,6 +1569,15 @@ def dashboard():
                 "data": daily_mileage
             })
 
+        # emisi semua plate dihitung sekali (vektor), total per kategori BBM
+        emisi = hitung_emisi_batch([s["fuel_consumption"] for s in summary_data],
+                                   [s["fuel_type"] or "None" for s in summary_data])
+        for s, kg, ton in zip(summary_data, emisi["rows"]["Total_CO2e_kg"], emisi["rows"]["Total_CO2e_ton"]):
+            s["emisi_total_ton"] = round(float(ton), 2)
+            s["emisi_total_kg"] = round(float(kg), 2)
+        gasoline = emisi["by_fuel"].get("gasoline", {})
+        diesel = emisi["by_fuel"].get("diesel", {})
+
         # Tentukan chart type
         if search_plate:
             chart_type = "line"  # single plate
@@ -424,6 +1585,7 @@ def dashboard():
             chart_type = "line"  # multi-plate multi-day
         else:
             chart_type = "bar"   # semua kendaraan 1 hari
+        mark_stage("aggregate")
 
         return render_template(
             "dashboard.html",
@@ -432,10 +1594,10 @@ def dashboard():
             start_time=start_time,
             end_time=end_time,
             summary_data=summary_data,
-            total_gasoline=round(total_gasoline, 2),
-            total_diesel=round(total_diesel, 2),
-            total_emisi_gasoline=round(total_emisi_gasoline, 2),
-            total_emisi_diesel=round(total_emisi_diesel, 2),
+            total_gasoline=round(gasoline.get("volume_liter", 0), 2),
+            total_diesel=round(diesel.get("volume_liter", 0), 2),
+            total_emisi_gasoline=round(gasoline.get("Total_CO2e_ton", 0), 2),
+            total_emisi_diesel=round(diesel.get("Total_CO2e_ton", 0), 2),
             chart_type=chart_type,
             chart_labels=chart_labels,
             chart_datasets=chart_datasets
@@ -445,73 +1607,223 @@ def dashboard():
         import traceback
         return f"<pre>{traceback.format_exc()}</pre>"
 
+@app.route('/api/emissions')
+def api_emissions():
+    """Emisi armada per hari / bulan dan per kategori BBM: ?start_date=&end_date=&plate=all&group=day|month"""
+    start_date = request.args.get("start_date") or local_yesterday()
+    end_date = request.args.get("end_date") or start_date
+    group = request.args.get("group", "day")
+    if group not in ("day", "month"):
+        return jsonify({"error": "group harus day atau month"}), 400
+    try:
+        date_range(start_date, end_date)
+    except ValueError:
+        return jsonify({"error": "tanggal tidak valid"}), 400
+
+    targets = report_targets(load_report_vehicles(), request.args.get("plate", "all"))
+    rollups = get_daily_rollups([(imei, plate, fuel_type) for imei, plate, _, fuel_type in targets],
+                                start_date, end_date)
+    mark_stage("fetch")
+
+    # satu baris per (kendaraan, hari) -> satu perhitungan vektor
+    liters, fuels, periods = [], [], []
+    for imei, _, _, fuel_type in targets:
+        efficiency = EFFICIENCY_BY_FUEL.get(fuel_type, 15)
+        for day, row in rollups.get(imei, {}).items():
+            liters.append(row["mileage_km"] / efficiency)
+            fuels.append(fuel_type)
+            periods.append(day if group == "day" else day[:7])
+    emisi = hitung_emisi_batch(liters, fuels, group_by=periods)
+    mark_stage("aggregate")
+
+    return jsonify({
+        "start_date": start_date,
+        "end_date": end_date,
+        "group": group,
+        "vehicles": len(targets),
+        "by_period": emisi["by_group"],
+        "by_fuel": emisi["by_fuel"],
+        "total": emisi["total"]
+    })
+
 # =========================== VEHICLES DATA ===========================
 
 def get_vehicle_info(imei):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
+    row = vehicles_db.query_one("""
         SELECT plate, COALESCE(custom_name, device_name), status, fuel_type
         FROM vehicles_status
         WHERE imei=?
     """, (imei,))
-    row = c.fetchone()
-    conn.close()
     if row:
         return row[0], row[1], row[2], row[3]  # plate, name, status, fuel_type
     return None, None, None, None
 
 
-@app.route('/vehicles')
-def vehicles():
-    token = get_token()
-    if not token:
-        return "Gagal mendapatkan token dari GPS.id", 500
+# Snapshot live /vehicle (speed, mileage, last_update) dipakai bersama semua
+# request: di-refresh di background tiap VEHICLE_REFRESH_INTERVAL detik.
+# Snapshot yang sudah lewat interval tetap langsung dipakai (stale-while-
+# revalidate) sambil refresh jalan di background; baru kalau umurnya lewat
+# VEHICLE_MAX_STALE request menunggu refresh. Tiap refresh juga sinkron ke
+# vehicles_status (satu transaksi), jadi halaman /vehicles tidak menulis ke DB.
+VEHICLE_REFRESH_INTERVAL = int(os.getenv("VEHICLE_REFRESH_INTERVAL", 60))
+VEHICLE_MAX_STALE = int(os.getenv("VEHICLE_MAX_STALE", 600))
 
-    try:
-        response = requests.get(
-            "https://portal.gps.id/backend/seen/public/vehicle",
-            headers={"Authorization": f"Bearer {token}"}
-        )
 
-        if response.status_code != 200:
-            return f"<h3>Gagal ambil data GPS.id: {response.status_code}</h3><pre>{response.text}</pre>", 500
+def sync_vehicles(api_data):
+    """Terapkan snapshot /vehicle ke vehicles_status. Return jumlah kendaraan"""
+    rows = [
+        (str(item.get("imei", "")).strip(), item.get("plate", "-"), item.get("device_name", "-"))
+        for item in api_data
+    ]
+    rows = [r for r in rows if r[0]]
+    vehicles_db.executemany("""
+        INSERT OR IGNORE INTO vehicles_status (imei, plate, device_name, status)
+        VALUES (?, ?, ?, 'Tidak Aktif')
+    """, rows)
+    return len(rows)
 
-        api_data = response.json().get("message", {}).get("data", [])
 
-        kendaraan_list = []
-        for item in api_data:
-            imei = str(item.get("imei", "")).strip()
-            if not imei:
-                continue
+def join_vehicle_rows(api_data):
+    """Data live API + vehicles_status (custom_name, status, fuel_type) untuk tabel /vehicles"""
+    db_rows = {r[0]: r[1:] for r in vehicles_db.query("""
+        SELECT imei, plate, COALESCE(custom_name, device_name), status, fuel_type
+        FROM vehicles_status
+    """)}
+    kendaraan_list = []
+    for item in api_data:
+        imei = str(item.get("imei", "")).strip()
+        if not imei:
+            continue
+        # jaga-jaga kalau baris DB belum ada: tampil dengan data API
+        plate, vehicle_name, status, fuel_type = db_rows.get(imei) or (
+            item.get("plate", "-"), item.get("device_name", "-"), "Tidak Aktif", None)
+
+        kendaraan_list.append({
+            "imei": imei,
+            "plate": plate,
+            "custom_name": None,
+            "device_name": vehicle_name,
+            "speed": item.get("speed", 0),
+            "mileage": item.get("mileage", 0),
+            "last_update": item.get("last_update", "-"),
+            "status": status,
+            "fuel_type": fuel_type if fuel_type else "None"
+        })
+    return kendaraan_list
+
+
+class VehicleSnapshot:
+
+    def __init__(self, fetch, interval=VEHICLE_REFRESH_INTERVAL, max_stale=VEHICLE_MAX_STALE):
+        self.fetch = fetch
+        self.interval = interval
+        self.max_stale = max(max_stale, interval)
+        self.data = None
+        self.fetched_at = 0.0
+        self.error = None
+        self.refreshes = self.stale_hits = 0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def age(self):
+        return time.time() - self.fetched_at if self.data is not None else None
+
+    def get(self):
+        """Daftar kendaraan terbaru yang ada; refresh hanya kalau perlu"""
+        age = self.age()
+        if age is not None and age < self.interval:
+            return self.data
+        if age is not None and age < self.max_stale:
+            with self.lock:
+                self.stale_hits += 1
+            self.refresh_async()
+            return self.data
+        # belum ada snapshot / terlalu basi: tunggu (request lain ikut menunggu refresh yang sama)
+        self.refresh(min_age=self.interval)
+        if self.data is None:
+            raise GPSError(f"Snapshot kendaraan belum tersedia: {self.error}")
+        return self.data
+
+    def refresh(self, min_age=0):
+        with self.refresh_lock:
+            age = self.age()
+            if age is not None and age < min_age:
+                return  # sudah di-refresh request lain selagi menunggu lock
+            try:
+                data = self.fetch()
+                sync_vehicles(data)
+            except Exception as e:
+                self.error = str(e)
+                logging.error(f"❌ Refresh snapshot kendaraan gagal: {e}")
+                return
+            with self.lock:
+                self.data, self.fetched_at, self.error = data, time.time(), None
+                self.refreshes += 1
+
+    def refresh_async(self):
+        if self.refresh_lock.locked():
+            return
+        threading.Thread(target=self.refresh, kwargs={"min_age": self.interval},
+                         name="vehicle-refresh", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            self.refresh(min_age=self.interval / 2)
+            time.sleep(self.interval)
 
-            plate_api = item.get("plate", "-")
-            device_name_api = item.get("device_name", "-")
+    def start(self):
+        if self.interval <= 0:
+            return
+        threading.Thread(target=self._loop, name="vehicle-snapshot", daemon=True).start()
+        logging.info(f"🚗 Snapshot kendaraan di-refresh tiap {self.interval} detik")
 
-            # pastikan ada di DB
-            upsert_vehicle(imei, plate_api, device_name_api)
+    def stats(self):
+        age = self.age()
+        return {
+            "fetched_at": datetime.fromtimestamp(self.fetched_at, LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S") if self.data is not None else None,
+            "age_s": round(age, 1) if age is not None else None,
+            "stale": age is None or age >= self.interval,
+            "count": len(self.data or []),
+            "refreshes": self.refreshes,
+            "stale_hits": self.stale_hits,
+            "error": self.error
+        }
 
-            # ambil dari DB supaya custom_name kepakai
-            plate, vehicle_name, status, fuel_type = get_vehicle_info(imei)
 
-            kendaraan_list.append({
-                "imei": imei,
-                "plate": plate,
-                "custom_name": None,
-                "device_name": vehicle_name,
-                "speed": item.get("speed", 0),
-                "mileage": item.get("mileage", 0),
-                "last_update": item.get("last_update", "-"),
-                "status": status,
-                "fuel_type": fuel_type if fuel_type else "None"
-            })
+vehicle_snapshot = VehicleSnapshot(gps_client.vehicles)
+metrics.describe("vehicle_snapshot_age_seconds", "gauge", "Umur snapshot /vehicle yang sedang dipakai")
+metrics.describe("vehicle_snapshot_refreshes_total", "counter", "Refresh snapshot /vehicle yang berhasil")
 
+
+@metrics.collector
+def vehicle_snapshot_metrics():
+    age = vehicle_snapshot.age()
+    if age is not None:
+        yield "vehicle_snapshot_age_seconds", {}, round(age, 1)
+    yield "vehicle_snapshot_refreshes_total", {}, vehicle_snapshot.refreshes
+
+
+@app.route('/vehicles')
+def vehicles():
+    try:
+        kendaraan_list = join_vehicle_rows(vehicle_snapshot.get())
         return render_template("vehicles.html", kendaraan=kendaraan_list)
 
+    except GPSError as e:
+        return f"<h3>Gagal ambil data GPS.id</h3><pre>{e}</pre>", 500
     except Exception:
         import traceback
         return f"<h3>Terjadi Error</h3><pre>{traceback.format_exc()}</pre>", 500
 
+
+@app.route('/api/vehicles')
+def api_vehicles():
+    try:
+        data = vehicle_snapshot.get()
+    except GPSError as e:
+        return jsonify({"error": str(e)}), 502
+    return jsonify({"snapshot": vehicle_snapshot.stats(), "vehicles": join_vehicle_rows(data)})
+
 @app.route('/update_status', methods=['POST'])
 def update_status_route():
     data = request.get_json()
@@ -530,15 +1842,7 @@ def update_name():
     custom_name = data.get('custom_name')
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("""
-            UPDATE vehicles_status
-            SET custom_name = ?
-            WHERE imei = ?
-        """, (custom_name, imei))
-        conn.commit()
-        conn.close()
+        update_custom_name(imei, custom_name)
         return jsonify(success=True)
     except Exception as e:
         return jsonify(success=False, error=str(e)), 500
@@ -549,10 +1853,13 @@ def update_fuel_type():
     imei = data.get("imei")
     fuel_type = data.get("fuel_type")
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE vehicles_status SET fuel_type=? WHERE imei=?", (fuel_type, imei))
-    conn.commit()
+    update_vehicle_fuel_type(imei, fuel_type)
+
+    # BBM di tabel rekap ikut efisiensi jenis BBM yang baru
+    conn = historical_conn()
+    with conn:
+        conn.execute("UPDATE historical SET fuel_used = mileage / ? WHERE imei=?",
+                     (EFFICIENCY_BY_FUEL.get(fuel_type, 15), imei))
     conn.close()
 
     return jsonify({"success": True})
@@ -565,15 +1872,128 @@ def safe_rows(rows):
     return rows
 
 
+# =========================== SIMPLIFIKASI TRACK ===========================
+# Track dikurangi pakai Douglas–Peucker (toleransi dalam meter) sampai muat di
+# budget titik. Titik penting (awal/akhir berhenti, mesin on/off, belokan
+# tajam) selalu dipertahankan.
+EARTH_RADIUS_M = 6_371_000
+MAPS_TOLERANCE_M = float(os.getenv("MAPS_TOLERANCE_M", 10))
+MAPS_MAX_POINTS = int(os.getenv("MAPS_MAX_POINTS", 2000))
+SHARP_TURN_DEG = 45
+MIN_TURN_SEGMENT_M = 5  # abaikan "belokan" dari jitter GPS saat diam
+
+
+def project_meters(lat, lon):
+    """Lat/lon -> x/y meter (equirectangular, cukup akurat untuk satu track)"""
+    lat0 = np.radians(np.mean(lat))
+    x = np.radians(lon) * EARTH_RADIUS_M * np.cos(lat0)
+    y = np.radians(lat) * EARTH_RADIUS_M
+    return x, y
+
+
+def track_feature_mask(x, y, speed, engine):
+    """Titik yang wajib disimpan: transisi mesin, awal/akhir berhenti, belokan tajam"""
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    for flags in (engine, speed <= 0):
+        change = flags[1:] != flags[:-1]
+        keep[1:] |= change
+        keep[:-1] |= change
+
+    if n >= 3:
+        vx, vy = np.diff(x), np.diff(y)
+        seg = np.hypot(vx, vy)
+        dot = vx[:-1] * vx[1:] + vy[:-1] * vy[1:]
+        denom = seg[:-1] * seg[1:]
+        cos_turn = np.divide(dot, denom, out=np.ones_like(dot), where=denom > 0)
+        keep[1:-1] |= (
+            (cos_turn < np.cos(np.radians(SHARP_TURN_DEG)))
+            & (seg[:-1] > MIN_TURN_SEGMENT_M) & (seg[1:] > MIN_TURN_SEGMENT_M)
+        )
+    return keep
+
+
+def douglas_peucker_mask(x, y, tolerance_m, keep):
+    """Douglas–Peucker iteratif antar titik wajib; jarak dihitung per segmen dengan NumPy"""
+    mask = keep.copy()
+    anchors = np.flatnonzero(mask)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        s, e = stack.pop()
+        if e - s < 2:
+            continue
+        xs, ys = x[s + 1:e], y[s + 1:e]
+        dx, dy = x[e] - x[s], y[e] - y[s]
+        seg_len2 = dx * dx + dy * dy
+        if seg_len2 == 0:
+            d = np.hypot(xs - x[s], ys - y[s])
+        else:
+            # jarak ke segmen s-e (proyeksi dibatasi di antara kedua ujung)
+            t = np.clip(((xs - x[s]) * dx + (ys - y[s]) * dy) / seg_len2, 0, 1)
+            d = np.hypot(xs - (x[s] + t * dx), ys - (y[s] + t * dy))
+        i = int(np.argmax(d))
+        if d[i] > tolerance_m:
+            m = s + 1 + i
+            mask[m] = True
+            stack.append((s, m))
+            stack.append((m, e))
+    return mask
+
+
+def simplify_track(points, tolerance_m=MAPS_TOLERANCE_M, max_points=MAPS_MAX_POINTS):
+    """points: list titik maps (Lat, Lon, speed, engine) yang sudah urut waktu"""
+    if len(points) <= 2:
+        return points
+
+    lat = np.array([float(p["Lat"]) for p in points])
+    lon = np.array([float(p["Lon"]) for p in points])
+    speed = np.array([float(p.get("speed") or 0) for p in points])
+    engine = np.array([str(p.get("engine") or 0) not in ("0", "False") for p in points])
+
+    x, y = project_meters(lat, lon)
+    keep = track_feature_mask(x, y, speed, engine)
+
+    # toleransi digandakan sampai jumlah titik masuk budget
+    tolerance = tolerance_m
+    for _ in range(12):
+        mask = douglas_peucker_mask(x, y, tolerance, keep)
+        if mask.sum() <= max_points:
+            break
+        tolerance *= 2
+
+    idx = np.flatnonzero(mask)
+    if len(idx) > max_points:
+        # titik wajib saja sudah melebihi budget -> ambil merata
+        idx = idx[np.linspace(0, len(idx) - 1, max_points).astype(int)]
+    return [points[i] for i in idx]
+
+
+def to_map_points(raw_data):
+    """Titik history -> titik maps (Lat, Lon, DatetimeUTC, speed, engine), urut waktu"""
+    points = []
+    for d in raw_data:
+        lat = d.get("lat")
+        lon = d.get("lon")
+        ts = d.get("time")
+        if lat and lon and ts:
+            points.append({
+                "Lat": lat,
+                "Lon": lon,
+                "DatetimeUTC": ts,
+                "speed": d.get("speed"),
+                "engine": d.get("engine")
+            })
+    points.sort(key=lambda x: x['DatetimeUTC'])
+    return points
+
+
 # =========================== MAPS ===========================
 
 
 @app.route("/maps", methods=["GET", "POST"])
 def maps():
-    token = get_token()
-    if not token:
-        return "Gagal mendapatkan token", 500
-
     df = load_active_vehicles()
     df['imei'] = df['imei'].astype(str).str.strip()
     plate_to_imei = {row['plate']: row['imei'] for _, row in df.iterrows()}
@@ -595,29 +2015,19 @@ def maps():
         end = end_dt.replace("T", " ")
 
         try:
-            raw_data = get_history_data(token, imei, start[:10], end[:10])
+            open_points = ingest_missing_days(imei, start[:10], end[:10])
+            raw_data = get_history_data(imei, start[:10], end[:10], open_points)
+            segments = vehicle_segments(imei, parse_track_time(start), parse_track_time(end, end=True), open_points)
         except Exception as e:
             return f"Error ambil data: {e}", 500
+        mark_stage("fetch")
 
-        points = []
-        for d in raw_data:
-            lat = d.get("lat")
-            lon = d.get("lon")
-            time = d.get("time")
-            if lat and lon and time:
-                points.append({
-                    "Lat": lat,
-                    "Lon": lon,
-                    "DatetimeUTC": time,
-                    "speed": d.get("speed"),
-                    "engine": d.get("engine")
-                })
-
-        points.sort(key=lambda x: x['DatetimeUTC'])
+        points = to_map_points(raw_data)
 
-        # Optimasi: ambil setiap N titik (misalnya setiap 10)
-        N = 10
-        filtered_data = [pt for i, pt in enumerate(points) if i % N == 0]
+        # Optimasi: sederhanakan track (Douglas–Peucker) sesuai budget titik
+        filtered_data = simplify_track(points)
+        logging.info(f"🗺️ {selected_plate}: {len(points)} → {len(filtered_data)} titik")
+        mark_stage("aggregate")
 
         return render_template("maps.html",
                                all_plates=all_plates,
@@ -627,7 +2037,7 @@ def maps():
                                start_time=start_dt,
                                end_time=end_dt,
                                rows=filtered_data,
-                               points=filtered_data,
+                               stops=[stop_json(s) for s in segments if s["kind"] == "stop"],
                                result=None)
 
     # GET method - initial load
@@ -639,74 +2049,1006 @@ def maps():
                            start_time="",
                            end_time="",
                            rows=[],
-                           points=[],
+                           stops=[],
                            result=None)
 
-# =========================== HISTORICAL DATA ===========================
-raw_history_cache = {}
-historical_cache = {}  # 🔑 Cache rekap historis
-historical_detail_cache = {}  # 🔑 Cache detail harian
+# =========================== TRACK API ===========================
+# Track beberapa kendaraan sekaligus dalam JSON ringkas (polyline-encoded)
+# atau GeoJSON. Tiap (imei, hari) disederhanakan sekali ke beberapa level
+# zoom ("piramida") dan hari yang sudah tutup disimpan di telemetry.db.
+# Response di-gzip, diberi ETag, dan mendukung If-None-Match (304).
+TRACK_ZOOM_LEVELS = (6, 9, 12, 15)
+TRACK_MAX_POINTS_PER_DAY = int(os.getenv("TRACK_MAX_POINTS_PER_DAY", 5000))
+TRACK_MAX_VEHICLES = int(os.getenv("TRACK_MAX_VEHICLES", 50))
+TRACK_MAX_DAYS = int(os.getenv("TRACK_MAX_DAYS", 31))
+TRACK_GZIP_MIN_BYTES = 1024
+
+
+def zoom_tolerance_m(zoom):
+    """Kira-kira ukuran 1 pixel (meter) di zoom Web Mercator dekat ekuator"""
+    return 156543.03 / (2 ** zoom)
+
+
+def track_level(zoom):
+    """Level piramida terkecil yang cukup detail untuk zoom yang diminta"""
+    for level in TRACK_ZOOM_LEVELS:
+        if level >= zoom:
+            return level
+    return TRACK_ZOOM_LEVELS[-1]
+
+
+def build_track_pyramid(points):
+    """Titik maps satu hari -> {level: kolom track yang sudah disederhanakan}"""
+    pyramid = {}
+    for level in TRACK_ZOOM_LEVELS:
+        simplified = simplify_track(points, zoom_tolerance_m(level), TRACK_MAX_POINTS_PER_DAY)
+        pyramid[level] = {
+            "lat": [float(p["Lat"]) for p in simplified],
+            "lon": [float(p["Lon"]) for p in simplified],
+            "time": [p["DatetimeUTC"] for p in simplified],
+            "speed": [round(float(p.get("speed") or 0)) for p in simplified],
+            "engine": [int(str(p.get("engine") or 0) not in ("0", "False")) for p in simplified],
+        }
+    return pyramid
+
+
+def load_track_pyramids(imei, days, level):
+    if not days:
+        return {}
+    conn = history_conn()
+    rows = conn.execute("""
+        SELECT date, payload FROM track_pyramids
+        WHERE imei=? AND level=? AND date BETWEEN ? AND ?
+    """, (imei, level, days[0], days[-1])).fetchall()
+    conn.close()
+    return {day: json.loads(payload) for day, payload in rows}
 
 
-# ================== SUMMARY UNTUK /historical ==================
-def get_summary_from_detail(token, imei, plate, device_name, start_date, end_date, fuel_type="Solar"):
-    """Ambil data detail harian lalu rekap total"""
-    cache_key = f"summary_{imei}_{start_date}_{end_date}"
-    if cache_key in historical_cache:
-        return historical_cache[cache_key]
-
-    # ========== ambil data seperti biasa ==========
-    current_start = datetime.strptime(start_date, "%Y-%m-%d")
-    current_end = datetime.strptime(end_date, "%Y-%m-%d")
-    all_data = []
-    while current_start <= current_end:
-        chunk_end = min(current_start + timedelta(days=6), current_end)
-        history = get_history_data(token, imei,
-                                   current_start.strftime("%Y-%m-%d"),
-                                   chunk_end.strftime("%Y-%m-%d"))
-        all_data.extend(history)
-        current_start = chunk_end + timedelta(days=1)
-
-    raw_key = f"{imei}_{start_date}_{end_date}"
-    raw_history_cache[raw_key] = all_data
-
-    # ========== proses mileage & speed ==========
-    grouped = defaultdict(lambda: {"total_speed": 0, "speed_count": 0,
-                                   "mileage_km": 0, "prev_odo": None})
-    all_data = sorted(
-        [d for d in all_data if d.get("time") and d.get("mileage") is not None],
-        key=lambda x: x['time']
-    )
+def save_track_pyramids(imei, pyramids):
+    """pyramids: {tanggal: {level: kolom}} -- hanya untuk hari yang sudah tutup"""
+    rows = [(imei, day, level, json.dumps(cols, separators=(",", ":")))
+            for day, pyramid in pyramids.items() for level, cols in pyramid.items()]
+    if not rows:
+        return
+    conn = history_conn()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO track_pyramids (imei, date, level, payload) VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+
+
+def vehicle_track(imei, start_ts, end_ts, level):
+    """Kolom track satu kendaraan untuk rentang waktu, dari piramida per hari
+
+    missing_days: hari lewat yang datanya belum lengkap di store (fetch gagal).
+    """
+    days = date_range(start_ts[:10], end_ts[:10])
+    by_day = load_track_pyramids(imei, days, level)
+    todo = [d for d in days if d not in by_day]
+    missing_days = []
+    if todo:
+        open_points = ingest_missing_days(imei, todo[0], todo[-1])
+        stored = get_stored_days(imei, todo[0], todo[-1])
+        today = local_today()
+        closed = {}
+        for day in todo:
+            if day in open_points:
+                raw = open_points[day]
+            else:
+                raw = load_stored_history(imei, day, day)
+            pyramid = build_track_pyramid(to_map_points(raw))
+            by_day[day] = pyramid[level]
+            if day in stored and day < today:
+                closed[day] = pyramid
+            elif day < today:
+                missing_days.append(day)
+        save_track_pyramids(imei, closed)
+
+    track = {k: [] for k in ("lat", "lon", "time", "speed", "engine")}
+    for day in days:
+        cols = by_day[day]
+        for i, ts in enumerate(cols["time"]):
+            if start_ts <= ts <= end_ts:
+                for k in track:
+                    track[k].append(cols[k][i])
+    track["missing_days"] = missing_days
+    return track
+
+
+def encode_polyline(lat, lon, precision=5):
+    """Google encoded polyline: delta koordinat, varint base64 (kompatibel Leaflet/Google)"""
+    if not len(lat):
+        return ""
+    coords = np.round(np.column_stack([lat, lon]) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    out = []
+    for v in deltas.tolist():
+        v = ~(v << 1) if v < 0 else v << 1
+        while v >= 0x20:
+            out.append(chr((0x20 | (v & 0x1f)) + 63))
+            v >>= 5
+        out.append(chr(v + 63))
+    return "".join(out)
+
+
+def encode_track(imei, plate, track):
+    """Format ringkas: polyline + waktu delta (detik) + speed + engine bitstring"""
+    times = track["time"]
+    secs = np.array(times, dtype="datetime64[s]").astype(np.int64)
+    return {
+        "imei": imei,
+        "plate": plate,
+        "points": len(times),
+        "polyline": encode_polyline(track["lat"], track["lon"]),
+        "t0": times[0] if times else None,
+        "dt": np.diff(secs).tolist(),
+        "speed": track["speed"],
+        "engine": "".join(str(e) for e in track["engine"]),
+        "missing_days": track["missing_days"],
+    }
+
+
+def track_feature(imei, plate, track):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [[round(lon, 5), round(lat, 5)] for lat, lon in zip(track["lat"], track["lon"])],
+        },
+        "properties": {
+            "imei": imei,
+            "plate": plate,
+            "times": track["time"],
+            "speed": track["speed"],
+            "engine": track["engine"],
+            "missing_days": track["missing_days"],
+        },
+    }
+
+
+def parse_track_time(value, end=False):
+    value = (value or "").strip().replace("T", " ")
+    if len(value) == 10:
+        value += " 23:59:59" if end else " 00:00:00"
+    elif len(value) == 16:
+        value += ":59" if end else ":00"
+    datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def request_list(name):
+    """?imei=a&imei=b atau ?imei=a,b"""
+    return [v.strip() for raw in request.args.getlist(name) for v in raw.split(",") if v.strip()]
+
+
+def request_vehicles():
+    """?imei= / ?plate= -> ([(imei, plate)] tanpa duplikat, [nilai yang tidak dikenal])"""
+    vehicles, unknown = [], []
+    for key, value in [("imei", v) for v in request_list("imei")] + [("plate", v) for v in request_list("plate")]:
+        row = get_vehicle(**{key: value})
+        if row:
+            vehicles.append((row[0], row[1]))
+        else:
+            unknown.append(value)
+    return list(dict.fromkeys(vehicles)), unknown
+
+
+def json_response(payload, cacheable):
+    """JSON + ETag/If-None-Match + gzip (kalau klien menerima)"""
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    use_gzip = len(body) >= TRACK_GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", "")
+    etag = hashlib.sha1(body).hexdigest() + ("-gz" if use_gzip else "")
+
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = "private, max-age=3600" if cacheable else "private, no-cache"
+    resp = resp.make_conditional(request)
+    if use_gzip and resp.status_code == 200:
+        resp.set_data(gzip.compress(body, compresslevel=6))
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+
+@app.route('/api/tracks')
+def api_tracks():
+    """Track multi-kendaraan.
+
+    Query: imei / plate (boleh berulang atau dipisah koma), start, end
+    (YYYY-MM-DD atau YYYY-MM-DDTHH:MM), zoom (default 12), format
+    (polyline | geojson).
+    """
+    try:
+        start_ts = parse_track_time(request.args.get("start"))
+        end_ts = parse_track_time(request.args.get("end") or request.args.get("start"), end=True)
+        zoom = int(request.args.get("zoom", 12))
+    except ValueError:
+        return jsonify({"error": "start/end/zoom tidak valid"}), 400
+    fmt = request.args.get("format", "polyline")
+    if fmt not in ("polyline", "geojson"):
+        return jsonify({"error": "format harus polyline atau geojson"}), 400
+    if end_ts < start_ts:
+        return jsonify({"error": "end harus setelah start"}), 400
+    if len(date_range(start_ts[:10], end_ts[:10])) > TRACK_MAX_DAYS:
+        return jsonify({"error": f"maksimal {TRACK_MAX_DAYS} hari per request"}), 400
+
+    vehicles, unknown = request_vehicles()
+    if unknown:
+        return jsonify({"error": "kendaraan tidak ditemukan", "unknown": unknown}), 404
+    if not vehicles:
+        return jsonify({"error": "isi minimal satu imei atau plate"}), 400
+    if len(vehicles) > TRACK_MAX_VEHICLES:
+        return jsonify({"error": f"maksimal {TRACK_MAX_VEHICLES} kendaraan per request"}), 400
+
+    level = track_level(zoom)
+    results = run_parallel(vehicle_track, [(imei, start_ts, end_ts, level) for imei, _ in vehicles])
+    for (imei, plate), result in zip(vehicles, results):
+        if isinstance(result, Exception):
+            logging.error(f"❌ Track {plate} ({imei}) gagal: {result}")
+            return jsonify({"error": f"gagal ambil track {plate}"}), 502
+    mark_stage("fetch")
+
+    if fmt == "geojson":
+        payload = {
+            "type": "FeatureCollection",
+            "features": [track_feature(imei, plate, track) for (imei, plate), track in zip(vehicles, results)],
+        }
+    else:
+        payload = {
+            "start": start_ts,
+            "end": end_ts,
+            "zoom": zoom,
+            "level": level,
+            "tolerance_m": round(zoom_tolerance_m(level), 1),
+            "tracks": [encode_track(imei, plate, track) for (imei, plate), track in zip(vehicles, results)],
+        }
+    mark_stage("aggregate")
+    # track yang bolong (ada hari gagal diambil) jangan sampai di-cache klien
+    complete = not any(track["missing_days"] for track in results)
+    return json_response(payload, cacheable=complete and end_ts[:10] < local_today())
+
+# =========================== TRIP & STOP ===========================
+# Stream titik per hari dipecah jadi trip dan stop saat ingest, lalu disimpan
+# di tabel trips (telemetry.db). Stop = kendaraan diam (speed <= TRIP_MIN_SPEED_KMH)
+# minimal TRIP_MIN_STOP_S; diam yang lebih singkat (lampu merah, macet) masuk
+# ke trip sebagai idle. "Trip" yang jaraknya < TRIP_MIN_DISTANCE_M (drift GPS
+# saat parkir) digabung ke stop di sekitarnya. Segmentasi per hari; stop/trip
+# yang terpotong tengah malam disambung lagi saat dibaca.
+TRIP_MIN_SPEED_KMH = float(os.getenv("TRIP_MIN_SPEED_KMH", 3))
+TRIP_MIN_STOP_S = int(os.getenv("TRIP_MIN_STOP_S", 300))
+TRIP_MIN_DISTANCE_M = float(os.getenv("TRIP_MIN_DISTANCE_M", 300))
+TRIP_MAX_GAP_S = 1800  # jeda maksimum antar hari supaya segmen disambung
+TRIP_MAX_DAYS = int(os.getenv("TRIP_MAX_DAYS", 31))
+TRIP_FIELDS = ("kind", "start_time", "end_time", "start_lat", "start_lon", "end_lat", "end_lon",
+               "distance_km", "duration_s", "moving_s", "idle_s", "max_speed", "point_count")
+
+
+def segment_points(points):
+    """Titik history satu hari -> list segmen {kind: trip|stop, ...} urut waktu"""
+    pts = sorted((p for p in points if p.get("time") and p.get("lat") and p.get("lon")), key=itemgetter("time"))
+    n = len(pts)
+    if n < 2:
+        return []
+
+    t = np.array([p["time"] for p in pts], dtype="datetime64[s]").astype(np.int64)
+    lat = np.array([float(p["lat"]) for p in pts])
+    lon = np.array([float(p["lon"]) for p in pts])
+    speed = np.array([float(p.get("speed") or 0) for p in pts])
+    engine = np.array([str(p.get("engine") or 0) not in ("0", "False") for p in pts])
+    odo = np.array([np.nan if p.get("mileage") is None else float(p["mileage"]) for p in pts])
+    moving = speed > TRIP_MIN_SPEED_KMH
+
+    # jarak per interval (titik i -> i+1): delta odometer, jatuh ke jarak lurus
+    # kalau odometer kosong / mundur / loncat
+    x, y = project_meters(lat, lon)
+    step = np.hypot(np.diff(x), np.diff(y))
+    d_odo = np.diff(odo)
+    valid = np.isfinite(d_odo) & (d_odo >= 0) & (d_odo < MAX_JUMP_KM * 1000)
+    step = np.where(valid, d_odo, step)
+
+    # kumulatif supaya total segmen [s, e] cukup cum[e] - cum[s]
+    dt = np.diff(t).astype(float)
+    cum_m = np.concatenate(([0.0], np.cumsum(step)))
+    cum_moving = np.concatenate(([0.0], np.cumsum(np.where(moving[:-1], dt, 0))))
+    cum_idle = np.concatenate(([0.0], np.cumsum(np.where(~moving[:-1] & engine[:-1], dt, 0))))
+
+    # run titik diam yang cukup lama -> stop [titik diam pertama, titik diam
+    # terakhir]; trip berikutnya mulai dari titik diam terakhir itu, jadi jarak
+    # ke titik jalan pertama masuk ke trip, bukan ke stop
+    change = np.flatnonzero(moving[1:] != moving[:-1]) + 1
+    bounds = np.concatenate(([0], change, [n]))
+    stops = []
+    for s, e in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        end = e - 1
+        if not moving[s] and t[end] - t[s] >= TRIP_MIN_STOP_S:
+            if stops and cum_m[s] - cum_m[stops[-1][1]] < TRIP_MIN_DISTANCE_M:
+                stops[-1][1] = end  # trip di antaranya cuma drift
+            else:
+                stops.append([s, end])
+    if stops and cum_m[stops[0][0]] < TRIP_MIN_DISTANCE_M:
+        stops[0][0] = 0
+    if stops and cum_m[n - 1] - cum_m[stops[-1][1]] < TRIP_MIN_DISTANCE_M:
+        stops[-1][1] = n - 1
+
+    def segment(kind, s, e):
+        return {
+            "kind": kind,
+            "start_time": pts[s]["time"],
+            "end_time": pts[e]["time"],
+            "start_lat": float(lat[s]),
+            "start_lon": float(lon[s]),
+            "end_lat": float(lat[e]),
+            "end_lon": float(lon[e]),
+            "distance_km": round((cum_m[e] - cum_m[s]) / 1000, 3),
+            "duration_s": int(t[e] - t[s]),
+            "moving_s": int(cum_moving[e] - cum_moving[s]),
+            "idle_s": int(cum_idle[e] - cum_idle[s]),
+            "max_speed": float(speed[s:e + 1].max()),
+            "point_count": e - s + 1,
+        }
+
+    segments, cursor = [], 0
+    for s, e in stops:
+        if s > cursor:
+            segments.append(segment("trip", cursor, s))
+        segments.append(segment("stop", s, e))
+        cursor = e
+    if cursor < n - 1 and (stops or cum_m[n - 1] >= TRIP_MIN_DISTANCE_M):
+        segments.append(segment("trip", cursor, n - 1))
+    return segments
+
+
+def segment_stored_days(imei, days):
+    """Segmentasi ulang hari yang sudah tutup dari history_points ke tabel trips"""
+    if not days:
+        return
+    days = sorted(days)
+    wanted = set(days)
+    rows, counts = [], {d: (0, 0) for d in days}
+    conn = history_conn()
+    try:
+        cur = conn.execute(f"""
+            SELECT date, {", ".join(HISTORY_FIELDS)}
+            FROM history_points
+            WHERE imei=? AND date BETWEEN ? AND ?
+            ORDER BY date, time
+        """, (imei, days[0], days[-1]))
+        for day, group in groupby(cur, key=itemgetter(0)):
+            if day not in wanted:
+                continue
+            segments = segment_points([dict(zip(HISTORY_FIELDS, r[1:])) for r in group])
+            rows.extend((imei, day) + tuple(s[f] for f in TRIP_FIELDS) for s in segments)
+            trips = sum(1 for s in segments if s["kind"] == "trip")
+            counts[day] = (trips, len(segments) - trips)
+        with conn:
+            conn.executemany("DELETE FROM trips WHERE imei=? AND date=?", [(imei, d) for d in days])
+            conn.executemany(f"""
+                INSERT INTO trips (imei, date, {", ".join(TRIP_FIELDS)})
+                VALUES ({", ".join("?" * (len(TRIP_FIELDS) + 2))})
+            """, rows)
+            conn.executemany("""
+                INSERT OR REPLACE INTO trip_days (imei, date, trip_count, stop_count)
+                VALUES (?, ?, ?, ?)
+            """, [(imei, d) + counts[d] for d in days])
+    finally:
+        conn.close()
+
+
+def merge_day_boundaries(segments):
+    """Stop/trip yang terpotong tengah malam (jenis sama, beda tanggal, jeda pendek) disambung"""
+    merged = []
+    for seg in segments:
+        prev = merged[-1] if merged else None
+        if (prev and prev["kind"] == seg["kind"] and prev["end_time"][:10] != seg["start_time"][:10]
+                and (datetime.strptime(seg["start_time"], "%Y-%m-%d %H:%M:%S")
+                     - datetime.strptime(prev["end_time"], "%Y-%m-%d %H:%M:%S")).total_seconds() <= TRIP_MAX_GAP_S):
+            merged[-1] = {
+                **prev,
+                "end_time": seg["end_time"],
+                "end_lat": seg["end_lat"],
+                "end_lon": seg["end_lon"],
+                "distance_km": round(prev["distance_km"] + seg["distance_km"], 3),
+                "duration_s": int((datetime.strptime(seg["end_time"], "%Y-%m-%d %H:%M:%S")
+                                   - datetime.strptime(prev["start_time"], "%Y-%m-%d %H:%M:%S")).total_seconds()),
+                "moving_s": prev["moving_s"] + seg["moving_s"],
+                "idle_s": prev["idle_s"] + seg["idle_s"],
+                "max_speed": max(prev["max_speed"], seg["max_speed"]),
+                "point_count": prev["point_count"] + seg["point_count"],
+            }
+        else:
+            merged.append(seg)
+    return merged
+
+
+def vehicle_segments(imei, start_ts, end_ts, open_points=None):
+    """Trip & stop satu kendaraan yang beririsan dengan start_ts..end_ts.
+
+    Hari tutup dibaca dari tabel trips (hari lama yang belum tersegmentasi
+    diproses sekali di sini); hari terbuka dihitung dari titik di memori.
+    open_points: hasil ingest_missing_days kalau pemanggil sudah mengambilnya.
+    """
+    days = date_range(start_ts[:10], end_ts[:10])
+    if open_points is None:
+        open_points = ingest_missing_days(imei, days[0], days[-1])
+    # hari sebelumnya ikut dibaca (kalau ada di store) untuk menyambung parkir malam
+    first = (datetime.strptime(days[0], "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    conn = history_conn()
+    done = {r[0] for r in conn.execute("SELECT date FROM trip_days WHERE imei=? AND date BETWEEN ? AND ?",
+                                       (imei, first, days[-1]))}
+    conn.close()
+    todo = get_stored_days(imei, first, days[-1]) - done
+    if todo:
+        segment_stored_days(imei, todo)
+
+    conn = history_conn()
+    rows = conn.execute(f"""
+        SELECT {", ".join(TRIP_FIELDS)} FROM trips
+        WHERE imei=? AND date BETWEEN ? AND ?
+        ORDER BY start_time
+    """, (imei, first, days[-1])).fetchall()
+    conn.close()
+    segments = [dict(zip(TRIP_FIELDS, r)) for r in rows]
+    for day in sorted(open_points):
+        if first <= day <= days[-1]:
+            segments.extend(segment_points(open_points[day]))
+
+    return [s for s in merge_day_boundaries(segments)
+            if s["end_time"] >= start_ts and s["start_time"] <= end_ts]
+
+
+def trip_json(seg):
+    moving_h = seg["moving_s"] / 3600
+    return {
+        "start_time": seg["start_time"],
+        "end_time": seg["end_time"],
+        "start": [round(seg["start_lat"], 6), round(seg["start_lon"], 6)],
+        "end": [round(seg["end_lat"], 6), round(seg["end_lon"], 6)],
+        "distance_km": round(seg["distance_km"], 2),
+        "duration_s": seg["duration_s"],
+        "moving_s": seg["moving_s"],
+        "idle_s": seg["idle_s"],
+        "max_speed": seg["max_speed"],
+        "avg_speed": round(seg["distance_km"] / moving_h, 1) if moving_h else 0,
+    }
+
+
+def stop_json(seg):
+    return {
+        "start_time": seg["start_time"],
+        "end_time": seg["end_time"],
+        "location": [round(seg["start_lat"], 6), round(seg["start_lon"], 6)],
+        "duration_s": seg["duration_s"],
+        "idle_s": seg["idle_s"],
+        # parkir = mesin mati hampir sepanjang stop, idle = mesin tetap hidup
+        "type": "idle" if seg["idle_s"] * 2 >= seg["duration_s"] else "parking",
+    }
+
+
+def segments_response(kind):
+    """Isi /api/trips dan /api/stops"""
+    try:
+        start_ts = parse_track_time(request.args.get("start") or local_yesterday())
+        end_ts = parse_track_time(request.args.get("end") or start_ts[:10], end=True)
+        min_duration = int(request.args.get("min_duration", 0))
+    except ValueError:
+        return jsonify({"error": "start/end/min_duration tidak valid"}), 400
+    if end_ts < start_ts:
+        return jsonify({"error": "end harus setelah start"}), 400
+    if len(date_range(start_ts[:10], end_ts[:10])) > TRIP_MAX_DAYS:
+        return jsonify({"error": f"maksimal {TRIP_MAX_DAYS} hari per request"}), 400
+    stop_type = request.args.get("type")
+    if stop_type not in (None, "parking", "idle"):
+        return jsonify({"error": "type harus parking atau idle"}), 400
+
+    vehicles, unknown = request_vehicles()
+    if unknown:
+        return jsonify({"error": "kendaraan tidak ditemukan", "unknown": unknown}), 404
+    if not vehicles:
+        # tanpa filter: semua kendaraan aktif
+        vehicles = [(str(v["imei"]), v["plate"]) for v in get_active_vehicles()]
+
+    results = run_parallel(vehicle_segments, [(imei, start_ts, end_ts) for imei, _ in vehicles])
+    mark_stage("fetch")
+
+    out = []
+    for (imei, plate), segments in zip(vehicles, results):
+        if isinstance(segments, Exception):
+            logging.error(f"❌ Segmen {plate} ({imei}) gagal: {segments}")
+            return jsonify({"error": f"gagal ambil data {plate}"}), 502
+        segments = [s for s in segments if s["kind"] == kind and s["duration_s"] >= min_duration]
+        if kind == "trip":
+            items = [trip_json(s) for s in segments]
+            summary = {
+                "trips": len(items),
+                "distance_km": round(sum(s["distance_km"] for s in segments), 2),
+                "moving_s": sum(s["moving_s"] for s in segments),
+                "idle_s": sum(s["idle_s"] for s in segments),
+            }
+        else:
+            items = [i for i in map(stop_json, segments) if not stop_type or i["type"] == stop_type]
+            summary = {
+                "stops": len(items),
+                "parking_s": sum(i["duration_s"] for i in items if i["type"] == "parking"),
+                "idle_s": sum(i["duration_s"] for i in items if i["type"] == "idle"),
+            }
+        out.append({"imei": imei, "plate": plate, "summary": summary, f"{kind}s": items})
+
+    return json_response({"start": start_ts, "end": end_ts, "vehicles": out},
+                         cacheable=end_ts[:10] < local_today())
+
+
+@app.route('/api/trips')
+def api_trips():
+    """Trip per kendaraan: ?imei= / plate= (boleh berulang, kosong = semua aktif), start, end"""
+    return segments_response("trip")
+
+
+@app.route('/api/stops')
+def api_stops():
+    """Stop per kendaraan: seperti /api/trips + min_duration (detik), type=parking|idle"""
+    return segments_response("stop")
+
+# =========================== GEOFENCE ===========================
+# Index spasial titik GPS yang sudah tersimpan: titik berurutan satu kendaraan
+# dikelompokkan jadi bucket kecil (<= GEO_BUCKET_POINTS titik, bentang
+# <= GEO_BUCKET_SPAN_M), lalu kotak lat/lon/waktu tiap bucket dimasukkan ke
+# R*Tree SQLite (geo_index). Query geofence cukup mengambil bucket yang kotaknya
+# beririsan dengan geofence + rentang waktu, lalu mengecek titik di bucket itu
+# saja. Kalau SQLite tidak punya modul rtree, kotak dicari di tabel
+# geo_buckets biasa (lebih lambat, hasil sama).
+GEO_BUCKET_POINTS = 64
+GEO_BUCKET_SPAN_M = float(os.getenv("GEO_BUCKET_SPAN_M", 1000))
+GEO_VISIT_GAP_S = int(os.getenv("GEO_VISIT_GAP_S", 600))  # keluar sebentar (jitter) tetap satu kunjungan
+GEO_MAX_DAYS = int(os.getenv("GEO_MAX_DAYS", 31))
+GEO_MAX_RADIUS_M = 50_000
+
+
+def to_epoch(times):
+    return np.array(times, dtype="datetime64[s]").astype(np.int64)
+
+
+def build_geo_buckets(points):
+    """Titik satu hari (urut waktu) -> [(start_time, end_time, min_lat, max_lat, min_lon, max_lon, n)]"""
+    pts = [p for p in points if p.get("time") and p.get("lat") and p.get("lon")]
+    if not pts:
+        return []
+    lat = [float(p["lat"]) for p in pts]
+    lon = [float(p["lon"]) for p in pts]
+    x, y = (a.tolist() for a in project_meters(np.array(lat), np.array(lon)))
+
+    # loop Python biasa: bucket rata-rata cuma beberapa titik, NumPy per bucket justru lebih lambat
+    buckets, s = [], 0
+    x0 = x1 = x[0]
+    y0 = y1 = y[0]
+    for i in range(1, len(pts) + 1):
+        if i < len(pts) and i - s < GEO_BUCKET_POINTS:
+            nx0, nx1 = min(x0, x[i]), max(x1, x[i])
+            ny0, ny1 = min(y0, y[i]), max(y1, y[i])
+            if nx1 - nx0 <= GEO_BUCKET_SPAN_M and ny1 - ny0 <= GEO_BUCKET_SPAN_M:
+                x0, x1, y0, y1 = nx0, nx1, ny0, ny1
+                continue
+        lats, lons = lat[s:i], lon[s:i]
+        buckets.append((pts[s]["time"], pts[i - 1]["time"], min(lats), max(lats), min(lons), max(lons), i - s))
+        if i < len(pts):
+            s = i
+            x0 = x1 = x[i]
+            y0 = y1 = y[i]
+    return buckets
+
+
+def index_stored_days(imei, days):
+    """Bangun ulang bucket + entri R*Tree untuk hari yang sudah tutup"""
+    if not days:
+        return
+    days = sorted(days)
+    wanted = set(days)
+    conn = history_conn()
+    try:
+        cur = conn.execute("""
+            SELECT date, time, lat, lon
+            FROM history_points
+            WHERE imei=? AND date BETWEEN ? AND ?
+            ORDER BY date, time
+        """, (imei, days[0], days[-1]))
+        by_day = {d: [] for d in days}
+        for day, group in groupby(cur, key=itemgetter(0)):
+            if day in wanted:
+                by_day[day] = build_geo_buckets([{"time": r[1], "lat": r[2], "lon": r[3]} for r in group])
+
+        with conn:
+            for day in by_day:
+                if geo_rtree_available():
+                    conn.execute("DELETE FROM geo_index WHERE id IN "
+                                 "(SELECT id FROM geo_buckets WHERE imei=? AND date=?)", (imei, day))
+                conn.execute("DELETE FROM geo_buckets WHERE imei=? AND date=?", (imei, day))
+            # id diberikan sendiri supaya bisa executemany; aman karena sudah di dalam transaksi tulis
+            next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM geo_buckets").fetchone()[0]
+            rows = [(imei, day, seq) + b for day, buckets in by_day.items() for seq, b in enumerate(buckets)]
+            ids = range(next_id, next_id + len(rows))
+            conn.executemany("""
+                INSERT INTO geo_buckets (id, imei, date, seq, start_time, end_time,
+                                         min_lat, max_lat, min_lon, max_lon, point_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(i,) + r for i, r in zip(ids, rows)])
+            if geo_rtree_available() and rows:
+                t0 = to_epoch([r[3] for r in rows]).tolist()
+                t1 = to_epoch([r[4] for r in rows]).tolist()
+                conn.executemany("INSERT INTO geo_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(i, r[7], r[8], r[5], r[6], a, b) for i, r, a, b in zip(ids, rows, t0, t1)])
+            conn.executemany("INSERT OR REPLACE INTO geo_days (imei, date, bucket_count) VALUES (?, ?, ?)",
+                             [(imei, d, len(b)) for d, b in by_day.items()])
+    finally:
+        conn.close()
+
+
+def ensure_geo_index(imei, start_date, end_date):
+    """Pastikan hari tutup sudah di store + ter-index. Return titik hari terbuka"""
+    open_points = ingest_missing_days(imei, start_date, end_date)
+    conn = history_conn()
+    done = {r[0] for r in conn.execute("SELECT date FROM geo_days WHERE imei=? AND date BETWEEN ? AND ?",
+                                       (imei, start_date, end_date))}
+    conn.close()
+    todo = get_stored_days(imei, start_date, end_date) - done
+    if todo:
+        index_stored_days(imei, todo)
+    return open_points
+
+
+# ---------- definisi geofence (vehicles.db) ----------
+_geofences_ready = False
+
+
+def ensure_geofences_table():
+    """Tabel dibuat saat pertama dipakai (app juga bisa di-import gunicorn / flask run)"""
+    global _geofences_ready
+    if _geofences_ready:
+        return
+    with _db_init_lock:
+        # poligon disimpan sebagai JSON [[lat, lon], ...]
+        vehicles_db.execute("""
+            CREATE TABLE IF NOT EXISTS geofences (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE,
+                kind TEXT,
+                lat REAL,
+                lon REAL,
+                radius_m REAL,
+                polygon TEXT,
+                created_at TEXT
+            )
+        """)
+    _geofences_ready = True
+
+
+def geofence_row(row):
+    fence_id, name, kind, lat, lon, radius_m, polygon, created_at = row
+    return {
+        "id": fence_id,
+        "name": name,
+        "kind": kind,
+        "lat": lat,
+        "lon": lon,
+        "radius_m": radius_m,
+        "polygon": json.loads(polygon) if polygon else None,
+        "created_at": created_at,
+    }
+
+
+def get_geofences():
+    ensure_geofences_table()
+    rows = vehicles_db.query("SELECT id, name, kind, lat, lon, radius_m, polygon, created_at FROM geofences ORDER BY name")
+    return [geofence_row(r) for r in rows]
+
+
+def get_geofence(fence_id):
+    ensure_geofences_table()
+    row = vehicles_db.query_one(
+        "SELECT id, name, kind, lat, lon, radius_m, polygon, created_at FROM geofences WHERE id=?", (fence_id,))
+    return geofence_row(row) if row else None
+
+
+def add_geofence(name, fence):
+    """Simpan geofence baru, return id-nya. sqlite3.IntegrityError kalau nama sudah ada"""
+    ensure_geofences_table()
+    return vehicles_db.insert("""
+        INSERT INTO geofences (name, kind, lat, lon, radius_m, polygon, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (name, fence["kind"], fence["lat"], fence["lon"], fence["radius_m"],
+          json.dumps(fence["polygon"]) if fence["polygon"] else None,
+          datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def delete_geofence(fence_id):
+    ensure_geofences_table()
+    vehicles_db.execute("DELETE FROM geofences WHERE id=?", (fence_id,))
+
+
+def parse_geofence(data):
+    """dict dari JSON / query string -> geofence (tanpa id). ValueError kalau tidak valid
+
+    Lingkaran: lat, lon, radius_m. Poligon: polygon = [[lat, lon], ...] atau
+    "lat,lon;lat,lon;..." (minimal 3 titik).
+    """
+    polygon = data.get("polygon")
+    if polygon:
+        if isinstance(polygon, str):
+            polygon = [pair.split(",") for pair in polygon.split(";") if pair.strip()]
+        polygon = [[float(lat), float(lon)] for lat, lon in polygon]
+        if len(polygon) < 3:
+            raise ValueError("polygon minimal 3 titik")
+        lats, lons = zip(*polygon)
+        return {"kind": "polygon", "polygon": polygon, "radius_m": None,
+                "lat": sum(lats) / len(lats), "lon": sum(lons) / len(lons)}
+
+    lat, lon, radius_m = float(data["lat"]), float(data["lon"]), float(data["radius_m"])
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat/lon di luar jangkauan")
+    if not 0 < radius_m <= GEO_MAX_RADIUS_M:
+        raise ValueError(f"radius_m harus 0 - {GEO_MAX_RADIUS_M}")
+    return {"kind": "circle", "lat": lat, "lon": lon, "radius_m": radius_m, "polygon": None}
+
+
+def fence_bbox(fence):
+    """(min_lat, max_lat, min_lon, max_lon)"""
+    if fence["kind"] == "polygon":
+        lats, lons = zip(*fence["polygon"])
+        return min(lats), max(lats), min(lons), max(lons)
+    dlat = np.degrees(fence["radius_m"] / EARTH_RADIUS_M)
+    dlon = dlat / max(np.cos(np.radians(fence["lat"])), 1e-6)
+    return fence["lat"] - dlat, fence["lat"] + dlat, fence["lon"] - dlon, fence["lon"] + dlon
+
+
+def fence_contains(fence, lat, lon):
+    """Mask titik (array lat/lon) yang ada di dalam geofence"""
+    if fence["kind"] == "circle":
+        dy = np.radians(lat - fence["lat"]) * EARTH_RADIUS_M
+        dx = np.radians(lon - fence["lon"]) * EARTH_RADIUS_M * np.cos(np.radians(fence["lat"]))
+        return np.hypot(dx, dy) <= fence["radius_m"]
+
+    # ray casting (planar; cukup untuk geofence ukuran lokasi)
+    poly = np.array(fence["polygon"])
+    inside = np.zeros(len(lat), dtype=bool)
+    for (ay, ax), (by, bx) in zip(poly, np.roll(poly, -1, axis=0)):
+        crosses = (ay > lat) != (by > lat)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = ax + (lat - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (lon < x_cross)
+    return inside
+
+
+# ---------- query kunjungan ----------
+
+def candidate_ranges(fence, start_ts, end_ts, imeis):
+    """Rentang waktu per (imei, tanggal) dari bucket yang kotaknya beririsan dengan geofence"""
+    min_lat, max_lat, min_lon, max_lon = fence_bbox(fence)
+    marks = ",".join("?" * len(imeis))
+    conn = history_conn()
+    if geo_rtree_available():
+        # CROSS JOIN: paksa R*Tree jadi loop luar (planner cenderung mulai dari index imei)
+        t0, t1 = to_epoch([start_ts, end_ts]).tolist()
+        rows = conn.execute(f"""
+            SELECT b.imei, b.date, b.seq, b.start_time, b.end_time
+            FROM geo_index r CROSS JOIN geo_buckets b ON b.id = r.id
+            WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+              AND r.max_t >= ? AND r.min_t <= ? AND b.imei IN ({marks})
+            ORDER BY b.imei, b.date, b.seq
+        """, (min_lon, max_lon, min_lat, max_lat, t0, t1, *imeis)).fetchall()
+    else:
+        rows = conn.execute(f"""
+            SELECT imei, date, seq, start_time, end_time
+            FROM geo_buckets
+            WHERE date BETWEEN ? AND ? AND end_time >= ? AND start_time <= ?
+              AND max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?
+              AND imei IN ({marks})
+            ORDER BY imei, date, seq
+        """, (start_ts[:10], end_ts[:10], start_ts, end_ts, min_lon, max_lon, min_lat, max_lat, *imeis)).fetchall()
+    conn.close()
+
+    # bucket berurutan (seq bersebelahan) digabung jadi satu rentang kontinu
+    ranges = defaultdict(list)
+    for imei, day, seq, start_time, end_time in rows:
+        runs = ranges[imei]
+        if runs and runs[-1][0] == day and runs[-1][1] == seq - 1:
+            runs[-1][1], runs[-1][3] = seq, end_time
+        else:
+            runs.append([day, seq, start_time, end_time])
+    return ranges, len(rows)
+
+
+def visits_in_run(fence, times, lat, lon):
+    """Potongan titik kontinu -> [(masuk, keluar, jumlah titik, lat, lon)] per run titik di dalam"""
+    inside = fence_contains(fence, lat, lon)
+    if not inside.any():
+        return []
+    edges = np.diff(np.concatenate(([0], inside.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+    return [(times[s], times[e], int(e - s + 1), float(lat[s]), float(lon[s])) for s, e in zip(starts, ends)]
+
+
+def merge_visits(visits):
+    """Kunjungan yang jedanya <= GEO_VISIT_GAP_S (jitter di tepi, ganti hari) digabung"""
+    merged = []
+    for enter, leave, n, lat, lon in sorted(visits):
+        if merged and (to_epoch([enter])[0] - to_epoch([merged[-1][1]])[0]) <= GEO_VISIT_GAP_S:
+            prev = merged[-1]
+            merged[-1] = (prev[0], max(prev[1], leave), prev[2] + n, prev[3], prev[4])
+        else:
+            merged.append((enter, leave, n, lat, lon))
+    return merged
+
+
+def fence_visits(fence, start_ts, end_ts, vehicles, open_results, min_dwell=0):
+    """Kunjungan kendaraan ke geofence.
+
+    vehicles: [(imei, plate)], open_results: titik hari terbuka per kendaraan
+    (hasil ensure_geo_index, urutan sama dengan vehicles).
+    """
+    t_query = time.perf_counter()
+    imeis = [imei for imei, _ in vehicles]
+    ranges, n_buckets = candidate_ranges(fence, start_ts, end_ts, imeis)
+    visits = defaultdict(list)
+    n_points = 0
+    conn = history_conn()
+    for imei, runs in ranges.items():
+        for day, _, start_time, end_time in runs:
+            rows = conn.execute("""
+                SELECT time, lat, lon FROM history_points
+                WHERE imei=? AND date=? AND time BETWEEN ? AND ? AND lat IS NOT NULL AND lon IS NOT NULL
+                ORDER BY time
+            """, (imei, day, max(start_time, start_ts), min(end_time, end_ts))).fetchall()
+            if rows:
+                n_points += len(rows)
+                times, lat, lon = zip(*rows)
+                visits[imei].extend(visits_in_run(fence, times, np.array(lat, dtype=float), np.array(lon, dtype=float)))
+    conn.close()
+
+    # hari terbuka belum ter-index: titiknya dicek langsung dari memori
+    for imei, open_points in zip(imeis, open_results):
+        for day in sorted(open_points):
+            pts = [p for p in open_points[day]
+                   if p.get("lat") and p.get("lon") and start_ts <= (p.get("time") or "") <= end_ts]
+            if pts:
+                n_points += len(pts)
+                visits[imei].extend(visits_in_run(
+                    fence, [p["time"] for p in pts],
+                    np.array([float(p["lat"]) for p in pts]), np.array([float(p["lon"]) for p in pts])))
+
+    out = []
+    for imei, plate in vehicles:
+        items = []
+        for enter, leave, n, lat, lon in merge_visits(visits.get(imei, [])):
+            dwell = int(to_epoch([leave])[0] - to_epoch([enter])[0])
+            if dwell >= min_dwell:
+                items.append({"enter": enter, "exit": leave, "dwell_s": dwell, "points": n,
+                              "entry": [round(lat, 6), round(lon, 6)]})
+        if items:
+            out.append({
+                "imei": imei,
+                "plate": plate,
+                "summary": {
+                    "visits": len(items),
+                    "dwell_s": sum(v["dwell_s"] for v in items),
+                    "first_seen": items[0]["enter"],
+                    "last_seen": items[-1]["exit"],
+                },
+                "visits": items,
+            })
+    stats = {
+        "vehicles_checked": len(vehicles),
+        "candidate_buckets": n_buckets,
+        "points_checked": n_points,
+        "query_ms": round((time.perf_counter() - t_query) * 1000, 1),
+        "index": "rtree" if geo_rtree_available() else "table",
+    }
+    return out, stats
+
+
+def visits_response(fence):
+    """Isi /api/geofences/<id>/visits dan /api/visits"""
+    try:
+        start_ts = parse_track_time(request.args.get("start") or local_yesterday())
+        end_ts = parse_track_time(request.args.get("end") or start_ts[:10], end=True)
+        min_dwell = int(request.args.get("min_dwell", 0))
+    except ValueError:
+        return jsonify({"error": "start/end/min_dwell tidak valid"}), 400
+    if end_ts < start_ts:
+        return jsonify({"error": "end harus setelah start"}), 400
+    if len(date_range(start_ts[:10], end_ts[:10])) > GEO_MAX_DAYS:
+        return jsonify({"error": f"maksimal {GEO_MAX_DAYS} hari per request"}), 400
+
+    vehicles, unknown = request_vehicles()
+    if unknown:
+        return jsonify({"error": "kendaraan tidak ditemukan", "unknown": unknown}), 404
+    if not vehicles:
+        vehicles = [(str(v["imei"]), v["plate"]) for v in get_active_vehicles()]
+    if not vehicles:
+        return jsonify({"error": "tidak ada kendaraan aktif"}), 400
+
+    days = date_range(start_ts[:10], end_ts[:10])
+    open_results = run_parallel(ensure_geo_index, [(imei, days[0], days[-1]) for imei, _ in vehicles])
+    for (imei, plate), result in zip(vehicles, open_results):
+        if isinstance(result, Exception):
+            logging.error(f"❌ Index geofence {plate} ({imei}) gagal: {result}")
+            return jsonify({"error": f"gagal ambil data {plate}"}), 502
+    mark_stage("fetch")
+
+    result, stats = fence_visits(fence, start_ts, end_ts, vehicles, open_results, min_dwell)
+    mark_stage("aggregate")
+    return jsonify({"geofence": fence, "start": start_ts, "end": end_ts, "vehicles": result, "stats": stats})
+
+
+@app.route('/api/geofences', methods=['GET', 'POST'])
+def api_geofences():
+    """GET: daftar geofence. POST (JSON/form): name + lat, lon, radius_m atau polygon"""
+    if request.method == "GET":
+        return jsonify(get_geofences())
+
+    data = request.get_json(silent=True) or request.form
+    name = (data.get("name") or "").strip()
+    if not name:
+        return jsonify({"error": "name wajib diisi"}), 400
+    try:
+        fence = parse_geofence(data)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"geofence tidak valid: {e}"}), 400
+    try:
+        fence_id = add_geofence(name, fence)
+    except sqlite3.IntegrityError:
+        return jsonify({"error": f"geofence '{name}' sudah ada"}), 409
+    return jsonify(get_geofence(fence_id)), 201
+
+
+@app.route('/api/geofences/<int:fence_id>', methods=['GET', 'DELETE'])
+def api_geofence(fence_id):
+    fence = get_geofence(fence_id)
+    if not fence:
+        return jsonify({"error": "geofence tidak ditemukan"}), 404
+    if request.method == "DELETE":
+        delete_geofence(fence_id)
+        return jsonify({"success": True})
+    return jsonify(fence)
+
+
+@app.route('/api/geofences/<int:fence_id>/visits')
+def api_geofence_visits(fence_id):
+    """Kunjungan ke geofence tersimpan: ?start=&end=&imei=/plate= (kosong = semua aktif)&min_dwell="""
+    fence = get_geofence(fence_id)
+    if not fence:
+        return jsonify({"error": "geofence tidak ditemukan"}), 404
+    return visits_response(fence)
+
+
+@app.route('/api/visits')
+def api_visits():
+    """"Siapa yang lewat sini": ?lat=&lon=&radius_m= atau ?polygon=lat,lon;lat,lon;... + start/end"""
+    try:
+        fence = parse_geofence(request.args)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"area tidak valid: {e}"}), 400
+    return visits_response({"id": None, "name": None, **fence})
 
-    for item in all_data:
-        date_str = item['time'][:10]
-        odo = item['mileage']
-        speed = item.get('speed', 0)
-        g = grouped[date_str]
+# =========================== HISTORICAL DATA ===========================
 
-        if g['prev_odo'] is not None and odo >= g['prev_odo']:
-            delta_km = (odo - g['prev_odo']) / 1000
-            if 0 < delta_km < 500:
-                g['mileage_km'] += delta_km
-        g['prev_odo'] = odo
 
-        if speed > 1:
-            g['total_speed'] += speed
-            g['speed_count'] += 1
+# ================== SUMMARY UNTUK /historical ==================
+def get_summary_from_detail(imei, plate, device_name, start_date, end_date, fuel_type="Solar", days=None):
+    """Rekap total periode dari rekap harian (days: hasil get_daily_rollups kalau sudah ada)"""
+    if days is None:
+        days = get_daily_rollups([(imei, plate, fuel_type)], start_date, end_date)[imei]
+    summary = summarize_days(days)
 
     # ========== rekap total ==========
-    total_mileage = sum(g['mileage_km'] for g in grouped.values())
+    total_mileage = summary.get("mileage_km", 0)
 
     # ✅ fuel_type spesifik
     eff = EFFICIENCY_BY_FUEL.get(fuel_type, 15)
     total_fuel = round(total_mileage / eff, 2) if total_mileage > 0 else 0
 
-    avg_speed_list = [g['total_speed'] / g['speed_count'] for g in grouped.values() if g['speed_count']]
-    avg_speed = round(sum(avg_speed_list) / len(avg_speed_list), 2) if avg_speed_list else 0
+    avg_speed = round(summary.get("avg_speed", 0), 2)
 
     if total_mileage == 0:
         status = "🛑 Tidak Bergerak"
-    elif not avg_speed_list:
+    elif not summary.get("speed_count"):
         status = "⚠️ Ada Mileage, Tapi Speed 0"
     else:
         status = "✅ OK"
@@ -723,25 +3065,63 @@ def get_summary_from_detail(token, imei, plate, device_name, start_date, end_dat
         "status": status
     }
 
-    historical_cache[cache_key] = result
     return result
 
 
+def load_report_vehicles():
+    """Kendaraan aktif untuk /historical (plate dinormalisasi, tanpa duplikat)"""
+    vehicles = {}
+    for v in get_active_vehicles():
+        v["plate"] = str(v["plate"]).strip().upper()
+        vehicles.setdefault(v["plate"], v)
+    return list(vehicles.values())
+
+
+def report_targets(active_vehicles, selected_plate="all"):
+    """[(imei, plate, device_name, fuel_type)] sesuai filter plate"""
+    return [
+        (str(v['imei']), v['plate'], v['device_name'], v.get("fuel_type") or "Solar")
+        for v in active_vehicles
+        if selected_plate == "all" or v["plate"] == selected_plate
+    ]
+
+
+def build_historical_report(targets, start_date, end_date, on_progress=None, on_error=None):
+    """Rekap periode per kendaraan (isi tabel /historical)
+
+    Kendaraan yang sebagian harinya gagal direkap ditandai status gagal +
+    field error, supaya tidak terbaca sebagai "tidak bergerak".
+    """
+    logging.info(f"🔄 Rekap {len(targets)} kendaraan periode {start_date} → {end_date}")
+    errors = defaultdict(list)
+
+    def record_error(imei, message):
+        errors[imei].append(message)
+        if on_error:
+            on_error(imei, message)
+
+    # semua hari yang belum ada di cache diambil sekaligus (paralel)
+    daily_rollups = get_daily_rollups(
+        [(imei, plate, fuel_type) for imei, plate, _, fuel_type in targets],
+        start_date, end_date, on_progress=on_progress, on_error=record_error
+    )
+    report = []
+    for imei, plate, device_name, fuel_type in targets:
+        row = get_summary_from_detail(imei, plate, device_name, start_date, end_date, fuel_type,
+                                      days=daily_rollups.get(imei, {}))
+        if errors.get(imei):
+            row["status"] = "❌ Gagal ambil data"
+            row["error"] = "; ".join(errors[imei])
+        report.append(row)
+    return report
+
+
 # ================== ROUTE /historical ==================
 @app.route('/historical')
 def historical_data():
     """Rekap per kendaraan (periode)"""
     try:
-        token = get_token()
-        active_vehicles = get_active_vehicles()
-
-        # pastikan DataFrame & hilangkan duplikat plate
-        if isinstance(active_vehicles, pd.DataFrame):
-            active_vehicles["plate"] = active_vehicles["plate"].astype(str).str.strip().str.upper()
-            active_vehicles = active_vehicles.drop_duplicates(subset=["plate"])
-            imei_list = active_vehicles.to_dict(orient="records")
-        else:
-            imei_list = active_vehicles
+        imei_list = load_report_vehicles()
 
         error, result = None, []
         start_date = request.args.get('start_date', '')
@@ -749,36 +3129,10 @@ def historical_data():
         selected_plate = request.args.get('plate', 'all')
 
         if start_date and end_date:
-            cache_key = f"{start_date}_{end_date}_{selected_plate}"
-            if cache_key in historical_cache:
-                result = historical_cache[cache_key]
-                logging.info(f"✅ Cache hit untuk {cache_key}, {len(result)} data diambil dari cache")
-            else:
-                vehicles = active_vehicles if selected_plate == "all" else active_vehicles[active_vehicles["plate"] == selected_plate]
-
-                for _, row in vehicles.iterrows():
-                    try:
-                        fuel_type = row["fuel_type"] if "fuel_type" in row and pd.notna(row["fuel_type"]) else "Solar"
-                        logging.info(f"🔄 Ambil data {row['plate']} ({fuel_type}) periode {start_date} → {end_date}")
-
-                        summary = get_summary_from_detail(
-                            token,
-                            str(row['imei']),
-                            row['plate'],
-                            row['device_name'],
-                            start_date,
-                            end_date,
-                            fuel_type
-                        )
-                        result.append(summary)
-                        logging.info(f"✅ Berhasil ambil data {row['plate']}")
-
-                    except Exception as e:
-                        logging.error(f"❌ Gagal ambil data {row['plate']} → {e}")
-                    time.sleep(1.5)
-
-                historical_cache[cache_key] = result
-                logging.info(f"💾 Data disimpan ke cache: {cache_key}")
+            result = build_historical_report(
+                report_targets(imei_list, selected_plate), start_date, end_date
+            )
+        mark_stage("fetch")
 
         return render_template(
             "historical.html",
@@ -787,6 +3141,7 @@ def historical_data():
             start_date=start_date,
             end_date=end_date,
             selected_plate=selected_plate,
+            failed=[r for r in result if r.get("error")],
             error=error
         )
     except Exception:
@@ -794,36 +3149,210 @@ def historical_data():
         import traceback
         return f"<pre>{traceback.format_exc()}</pre>"
 
+
+# ================== REPORT JOB (ASYNC) ==================
+# Rekap periode panjang dijalankan di background: browser cukup submit,
+# lalu polling progress dan ambil hasilnya kalau sudah selesai.
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 2))
+REPORT_JOBS_KEEP = 100
+
+_report_pool = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+report_jobs = OrderedDict()  # job_id -> ReportJob
+_report_jobs_lock = threading.Lock()
+
+
+class ReportJob:
+
+    def __init__(self, key, start_date, end_date, plate, targets):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.start_date = start_date
+        self.end_date = end_date
+        self.plate = plate
+        self.targets = targets
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+        self.days_per_vehicle = len(date_range(start_date, end_date))
+        self.days_done = defaultdict(int)  # imei -> hari selesai
+        self.failed = {}  # imei -> pesan error
+        self.lock = threading.Lock()
+
+    def on_progress(self, imei, days):
+        with self.lock:
+            self.days_done[imei] = min(self.days_per_vehicle, self.days_done[imei] + days)
+
+    def on_error(self, imei, message):
+        with self.lock:
+            self.failed[imei] = f"{self.failed[imei]}; {message}" if imei in self.failed else message
+
+    def run(self):
+        self.state = "running"
+        self.started_at = time.time()
+        try:
+            self.result = build_historical_report(self.targets, self.start_date, self.end_date,
+                                                  on_progress=self.on_progress, on_error=self.on_error)
+            self.state = "done"
+        except Exception as e:
+            logging.exception(f"🚨 Report job {self.id} gagal")
+            self.error = str(e)
+            self.state = "error"
+        finally:
+            self.finished_at = time.time()
+
+    def progress(self):
+        with self.lock:
+            days_done = sum(self.days_done.values())
+            failed = dict(self.failed)
+            vehicles_done = sum(1 for imei, d in self.days_done.items()
+                                if d >= self.days_per_vehicle and imei not in failed)
+        days_total = self.days_per_vehicle * len(self.targets)
+
+        eta = None
+        if self.state == "running" and days_done:
+            elapsed = time.time() - self.started_at
+            eta = round(elapsed / days_done * (days_total - days_done), 1)
+        elif self.state == "done":
+            eta = 0
+
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "plate": self.plate,
+            "vehicles_total": len(self.targets),
+            "vehicles_done": vehicles_done if self.state != "done" else len(self.targets) - len(failed),
+            "vehicles_failed": len(failed),
+            "failed": [{"imei": imei, "plate": plate, "error": failed[imei]}
+                       for imei, plate, _, _ in self.targets if imei in failed],
+            "days_total": days_total,
+            "days_done": days_done if self.state != "done" else days_total,
+            "eta_seconds": eta,
+            "error": self.error
+        }
+
+
+def submit_report_job(start_date, end_date, plate="all"):
+    """Job baru, atau job yang sama yang masih berjalan (digabung)"""
+    key = (start_date, end_date, plate)
+    with _report_jobs_lock:
+        for job in report_jobs.values():
+            if job.key == key and job.state in ("queued", "running"):
+                return job
+
+        job = ReportJob(key, start_date, end_date, plate,
+                        report_targets(load_report_vehicles(), plate))
+        report_jobs[job.id] = job
+        # buang job lama yang sudah selesai
+        while len(report_jobs) > REPORT_JOBS_KEEP:
+            old_id = next((j for j, o in report_jobs.items() if o.state in ("done", "error")), None)
+            if not old_id:
+                break
+            del report_jobs[old_id]
+
+    _report_pool.submit(job.run)
+    return job
+
+
+@app.route('/historical/jobs', methods=['POST'])
+def historical_job_submit():
+    data = request.get_json(silent=True) or request.form
+    start_date = data.get('start_date', '')
+    end_date = data.get('end_date', '')
+    plate = data.get('plate', 'all') or 'all'
+    if not start_date or not end_date:
+        return jsonify(success=False, message="start_date / end_date wajib diisi"), 400
+    try:
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        return jsonify(success=False, message="Format tanggal harus YYYY-MM-DD"), 400
+    if end_dt < start_dt:
+        return jsonify(success=False, message="Tanggal akhir harus setelah tanggal awal"), 400
+
+    job = submit_report_job(start_date, end_date, plate)
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status_url": url_for('historical_job_status', job_id=job.id),
+        "result_url": url_for('historical_job_result', job_id=job.id),
+        "report_url": url_for('historical_job_result', job_id=job.id, format="html")
+    }), 202
+
+
+@app.route('/historical/jobs/<job_id>')
+def historical_job_status(job_id):
+    job = report_jobs.get(job_id)
+    if not job:
+        return jsonify(success=False, message="Job tidak ditemukan"), 404
+    return jsonify(job.progress())
+
+
+@app.route('/historical/jobs/<job_id>/result')
+def historical_job_result(job_id):
+    job = report_jobs.get(job_id)
+    if not job:
+        return jsonify(success=False, message="Job tidak ditemukan"), 404
+    if job.state != "done":
+        return jsonify(job.progress()), 409
+
+    if request.args.get("format") == "xlsx":
+        import pandas as pd  # berat: hanya untuk ekspor Excel
+        df_export = pd.DataFrame(job.result)[["plate", "device_name", "date", "avg_speed",
+                                              "mileage_today", "fuel_used", "fuel_type", "status"]]
+        df_export.columns = [
+            "Plat", "Kendaraan", "Periode", "Rata-rata Kecepatan (km/h)",
+            "Jarak Tempuh (km)", "BBM Terpakai (L)", "Jenis BBM", "Status"
+        ]
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df_export.to_excel(writer, index=False, sheet_name='Rekap Periode')
+        output.seek(0)
+        return send_file(
+            output,
+            download_name=f"rekap_{job.plate}_{job.start_date}_to_{job.end_date}.xlsx",
+            as_attachment=True,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+
+    if request.args.get("format") == "html":
+        # hasil job dirender langsung; tidak merekap ulang di dalam request
+        return render_template(
+            "historical.html",
+            data=job.result,
+            imei_list=load_report_vehicles(),
+            start_date=job.start_date,
+            end_date=job.end_date,
+            selected_plate=job.plate,
+            failed=job.progress()["failed"],
+            error=None
+        )
+
+    return jsonify({"job": job.progress(), "data": job.result})
+
 # ================== DETAIL UNTUK /historical/detail ==================
 def get_all_plates():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
+    rows = vehicles_db.query("""
         SELECT imei, plate, COALESCE(custom_name, device_name) as device_name
         FROM vehicles_status
         WHERE status='Aktif'
     """)
-    rows = c.fetchall()
-    conn.close()
     return [{"imei": r[0], "plate": r[1], "device_name": r[2]} for r in rows]
 
 def get_vehicle(plate=None, imei=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
     if plate:
-        c.execute("SELECT imei, plate, COALESCE(custom_name, device_name) FROM vehicles_status WHERE plate=?", (plate.strip(),))
-    elif imei:
-        c.execute("SELECT imei, plate, COALESCE(custom_name, device_name) FROM vehicles_status WHERE imei=?", (imei.strip(),))
-    row = c.fetchone()
-    conn.close()
-    return row
+        return vehicles_db.query_one("SELECT imei, plate, COALESCE(custom_name, device_name) FROM vehicles_status WHERE plate=?", (plate.strip(),))
+    if imei:
+        return vehicles_db.query_one("SELECT imei, plate, COALESCE(custom_name, device_name) FROM vehicles_status WHERE imei=?", (imei.strip(),))
+    return None
 
 @app.route('/historical/detail')
 def historical_detail():
-    token = get_token()
-    if not token:
-        return "Gagal mendapatkan token dari GPS.id", 500
-
     plate = request.args.get('plate')
     imei = request.args.get('imei')
     start = request.args.get('start')
@@ -842,70 +3371,21 @@ def historical_detail():
         return "Kendaraan tidak ditemukan", 404
 
     imei, plate, device_name = vehicle
-    cache_key = f"{imei}_{start}_{end}"
+    fuel_type = get_vehicle_info(imei)[3] or "None"
+    efficiency = EFFICIENCY_BY_FUEL.get(fuel_type, 15)
 
-    # ================== AMBIL DATA RAW (CACHE / API) ==================
+    # ================== REKAP HARIAN (historical.db / API) ==================
     s_date = datetime.strptime(start, "%Y-%m-%d")
     e_date = datetime.strptime(end, "%Y-%m-%d")
 
-    if cache_key in raw_history_cache:
-        all_data = raw_history_cache[cache_key]
-        log_lines = ["[CACHE] Data diambil dari raw_history_cache (/historical)"]
-    else:
-        current_start = s_date
-        all_data = []
-        log_lines = []
-
-        while current_start <= e_date:
-            current_end = min(current_start + timedelta(days=6), e_date)
-            try:
-                history = get_history_data(
-                    token, imei,
-                    current_start.strftime("%Y-%m-%d"),
-                    current_end.strftime("%Y-%m-%d")
-                )
-                all_data.extend(history)
-                log_lines.append(
-                    f"Fetched {len(history)} data from {current_start.date()} to {current_end.date()}"
-                )
-            except Exception as e:
-                log_lines.append(
-                    f"Error fetching data {current_start.date()} - {current_end.date()}: {e}"
-                )
-            current_start = current_end + timedelta(days=1)
-
-        raw_history_cache[cache_key] = all_data  # simpan cache
-
-    # ================== PROSES DATA ==================
-    grouped = defaultdict(lambda: {
-        "total_speed": 0,
-        "speed_count": 0,
-        "mileage_km": 0,
-        "prev_odo": None
-    })
-
-    all_data = sorted(
-        [d for d in all_data if d.get("time") and d.get("mileage") is not None],
-        key=lambda x: x['time']
-    )
-
-    for item in all_data:
-        date_str = item['time'][:10]
-        odo = item['mileage']
-        speed = item.get('speed', 0)
-
-        group = grouped[date_str]
-
-        if group['prev_odo'] is not None and odo >= group['prev_odo']:
-            delta_km = (odo - group['prev_odo']) / 1000
-            if 0 < delta_km < 500:  # validasi wajar
-                group['mileage_km'] += delta_km
-
-        group['prev_odo'] = odo
-
-        if speed > 1:
-            group['total_speed'] += speed
-            group['speed_count'] += 1
+    log_lines = []
+    try:
+        grouped = get_daily_rollups([(imei, plate, fuel_type)], start, end)[imei]
+        log_lines.append(f"[ROLLUP] {len(grouped)} hari dari daily_cache / historical.db")
+    except Exception as e:
+        grouped = {}
+        log_lines.append(f"Error rekap data {start} - {end}: {e}")
+    mark_stage("fetch")
 
     result = []
     current_date = s_date
@@ -914,8 +3394,8 @@ def historical_detail():
         group = grouped.get(date_str, {})
 
         mileage_km = group.get("mileage_km", 0)
-        fuel_used = round(mileage_km / EFFICIENCY_KM_PER_LITER, 2) if mileage_km > 0 else 0
-        avg_speed = round(group['total_speed'] / group['speed_count'], 2) if group.get('speed_count', 0) > 0 else 0
+        fuel_used = round(mileage_km / efficiency, 2) if mileage_km > 0 else 0
+        avg_speed = round(group.get("avg_speed", 0), 2)
 
         result.append({
             "date": date_str,
@@ -926,44 +3406,31 @@ def historical_detail():
         })
         current_date += timedelta(days=1)
 
-    historical_detail_cache[cache_key] = result  # cache hasil
-
     # ================== DEBUG MODE ==================
     if debug:
         log_text = "\n".join(log_lines)
         return f"<pre>{log_text}</pre>"
 
     # ================== GRAFIK ==================
-    if result:
-        dates = [r['date'] for r in result]
-        mileage = [r['mileage_today'] for r in result]
-        fuel = [r['fuel_used'] for r in result]
-
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.plot(dates, mileage, marker='o', label='Mileage (km)')
-        ax.plot(dates, fuel, marker='x', label='Fuel Used (L)')
-        ax.set_xlabel("Tanggal")
-        ax.set_ylabel("Jumlah")
-        ax.set_title(f"Grafik Mileage & BBM - {plate}")
-        ax.legend()
-        ax.grid(True)
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-
-        chart_path = f"static/chart_{imei}_{start}_{end}.png"
-        fig.savefig(chart_path)
-        plt.close()
-    else:
-        chart_path = None
+    # seri dikirim ke Chart.js di browser (sama seperti dashboard), tanpa render PNG di server
+    chart_labels = [r['date'] for r in result]
+    chart_datasets = [
+        {"label": "Mileage (km)", "data": [r['mileage_today'] for r in result]},
+        {"label": "Fuel Used (L)", "data": [r['fuel_used'] for r in result]},
+    ]
+    if request.args.get("format") == "json":
+        return jsonify({"plate": plate, "labels": chart_labels, "datasets": chart_datasets})
 
     # ================== RINGKASAN ==================
     total_mileage = sum(r['mileage_today'] for r in result)
     total_fuel = sum(r['fuel_used'] for r in result)
     avg_speed_list = [r['avg_speed'] for r in result if r['avg_speed'] > 0]
     avg_speed = round(sum(avg_speed_list) / len(avg_speed_list), 2) if avg_speed_list else 0
+    mark_stage("aggregate")
 
     # ================== EKSPOR EXCEL ==================
     if request.args.get("export") == "1":
+        import pandas as pd  # berat: hanya untuk ekspor Excel
         df_export = pd.DataFrame(result)[["date", "plate", "avg_speed", "mileage_today", "fuel_used"]]
         df_export.columns = [
             "Tanggal", "Plat", "Rata-rata Kecepatan (km/h)",
@@ -991,13 +3458,313 @@ def historical_detail():
         start=start,
         end=end,
         vehicle_name=device_name,
-        chart_path=chart_path,
+        chart_labels=chart_labels,
+        chart_datasets=chart_datasets,
         total_mileage=round(total_mileage, 2),
         total_fuel=round(total_fuel, 2),
         avg_speed=avg_speed,
         all_plates=all_plates  # ✅ list kendaraan aktif
     )
 
+# =========================== EKSPOR ===========================
+# Detail harian seluruh armada untuk satu periode: xlsx (sheet ringkasan +
+# satu sheet per kendaraan), csv, atau parquet. Workbook ditulis dengan mode
+# constant_memory xlsxwriter ke file sementara: tiap baris langsung di-flush
+# ke disk, tidak ada DataFrame per kendaraan.
+EXPORT_MAX_DAYS = int(os.getenv("EXPORT_MAX_DAYS", 366))
+EXPORT_DAY_COLUMNS = [
+    "Tanggal", "Plat", "Rata-rata Kecepatan (km/h)", "Jarak Tempuh (km)", "BBM Terpakai (L)"
+]
+EXPORT_SUMMARY_COLUMNS = [
+    "Plat", "Kendaraan", "Jenis BBM", "Hari Aktif", "Jarak Tempuh (km)", "BBM Terpakai (L)",
+    "Rata-rata Kecepatan (km/h)", "CO2 (kg)", "CH4 (kg)", "N2O (kg)", "Total CO2e (kg)", "Total CO2e (ton)"
+]
+EXPORT_MIMETYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_vehicle_days(targets, rollups, days):
+    """Generator (kendaraan, [baris per hari]) -- satu kendaraan di memori per langkah"""
+    for imei, plate, device_name, fuel_type in targets:
+        efficiency = EFFICIENCY_BY_FUEL.get(fuel_type, 15)
+        by_day = rollups.get(imei, {})
+        rows = []
+        for d in days:
+            day = by_day.get(d, {})
+            mileage_km = day.get("mileage_km", 0)
+            rows.append((
+                d, plate,
+                round(day.get("avg_speed", 0), 2),
+                round(mileage_km, 2),
+                round(mileage_km / efficiency, 2) if mileage_km > 0 else 0
+            ))
+        yield (imei, plate, device_name, fuel_type), rows
+
+
+def export_summary_row(vehicle, rows):
+    _, plate, device_name, fuel_type = vehicle
+    total_km = sum(r[3] for r in rows)
+    total_fuel = sum(r[4] for r in rows)
+    speeds = [r[2] for r in rows if r[2] > 0]
+    return (
+        plate, device_name, fuel_type, sum(1 for r in rows if r[3] > 0),
+        round(total_km, 2), round(total_fuel, 2),
+        round(sum(speeds) / len(speeds), 2) if speeds else 0
+    )
+
+
+def with_emissions(summary_rows):
+    """Tambah kolom emisi ke baris ringkasan (satu perhitungan vektor untuk semua kendaraan)"""
+    emisi = hitung_emisi_batch([r[5] for r in summary_rows], [r[2] for r in summary_rows])["rows"]
+    return [
+        row + (round(float(co2), 2), round(float(ch4), 4), round(float(n2o), 4),
+               round(float(kg), 2), round(float(ton), 4))
+        for row, co2, ch4, n2o, kg, ton in zip(summary_rows, emisi["CO2_kg"], emisi["CH4_kg"],
+                                               emisi["N2O_kg"], emisi["Total_CO2e_kg"], emisi["Total_CO2e_ton"])
+    ]
+
+
+def excel_sheet_name(plate, used):
+    """Nama sheet Excel: maks 31 karakter, tanpa []:*?/\\, unik"""
+    name = "".join("_" if ch in '[]:*?/\\' else ch for ch in str(plate)).strip()[:31] or "Kendaraan"
+    base, n = name, 2
+    while name.lower() in used:
+        suffix = f" ({n})"
+        name = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(name.lower())
+    return name
+
+
+def write_fleet_xlsx(fh, targets, rollups, days):
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(fh, {"constant_memory": True})
+    header = workbook.add_format({"bold": True, "bg_color": "#0084F3", "font_color": "white"})
+    used = {"ringkasan"}
+
+    # sheet ringkasan dibuat duluan supaya jadi tab pertama; barisnya ditulis di akhir
+    summary = workbook.add_worksheet("Ringkasan")
+    summary.write_row(0, 0, EXPORT_SUMMARY_COLUMNS, header)
+    summary.set_column(0, len(EXPORT_SUMMARY_COLUMNS) - 1, 16)
+    summary_rows = []
+
+    for vehicle, rows in export_vehicle_days(targets, rollups, days):
+        sheet = workbook.add_worksheet(excel_sheet_name(vehicle[1], used))
+        sheet.set_column(0, len(EXPORT_DAY_COLUMNS) - 1, 18)
+        sheet.write_row(0, 0, EXPORT_DAY_COLUMNS, header)
+        for i, row in enumerate(rows, start=1):
+            sheet.write_row(i, 0, row)
+        summary_rows.append(export_summary_row(vehicle, rows))
+
+    summary_rows = with_emissions(summary_rows)
+    for i, row in enumerate(summary_rows, start=1):
+        summary.write_row(i, 0, row)
+    totals = ["TOTAL", "", "", ""] + [
+        round(sum(r[c] for r in summary_rows), 4) for c in range(4, len(EXPORT_SUMMARY_COLUMNS))
+    ]
+    totals[6] = ""  # rata-rata kecepatan tidak dijumlah
+    summary.write_row(len(summary_rows) + 1, 0, totals, header)
+    workbook.close()
+
+
+def iter_fleet_csv(targets, rollups, days):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["Kendaraan", "Jenis BBM"] + EXPORT_DAY_COLUMNS)
+    for (_, _, device_name, fuel_type), rows in export_vehicle_days(targets, rollups, days):
+        writer.writerows((device_name, fuel_type) + row for row in rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def write_fleet_parquet(fh, targets, rollups, days, pa, pq):
+    names = ["device_name", "fuel_type", "date", "plate", "avg_speed", "mileage_km", "fuel_used"]
+    columns = {n: [] for n in names}
+    for (_, _, device_name, fuel_type), rows in export_vehicle_days(targets, rollups, days):
+        for row in rows:
+            for n, v in zip(names, (device_name, fuel_type) + row):
+                columns[n].append(v)
+    pq.write_table(pa.table(columns), fh, compression="zstd")
+
+
+@app.route('/export')
+def export_fleet():
+    """Ekspor detail harian armada: ?start_date=&end_date=&plate=all&format=xlsx|csv|parquet"""
+    start_date = request.args.get("start_date", "")
+    end_date = request.args.get("end_date", "")
+    selected_plate = request.args.get("plate", "all")
+    fmt = request.args.get("format", "xlsx")
+
+    if fmt not in EXPORT_MIMETYPES:
+        return f"Format tidak dikenal: {fmt}", 400
+    try:
+        days = date_range(start_date, end_date)
+    except ValueError:
+        return "Parameter tanggal tidak valid", 400
+    if not days:
+        return "Tanggal akhir harus setelah tanggal awal", 400
+    if len(days) > EXPORT_MAX_DAYS:
+        return f"Maksimal {EXPORT_MAX_DAYS} hari per ekspor", 400
+
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            return "Ekspor parquet butuh paket pyarrow (pip install pyarrow)", 400
+
+    targets = report_targets(load_report_vehicles(), selected_plate)
+    if not targets:
+        return "Kendaraan tidak ditemukan", 404
+    rollups = get_daily_rollups([(imei, plate, fuel_type) for imei, plate, _, fuel_type in targets],
+                                start_date, end_date)
+    mark_stage("fetch")
+    scope = "armada" if selected_plate == "all" else selected_plate.replace(" ", "_")
+    filename = f"rekap_{scope}_{start_date}_to_{end_date}.{fmt}"
+
+    if fmt == "csv":
+        return app.response_class(
+            iter_fleet_csv(targets, rollups, days),
+            mimetype=EXPORT_MIMETYPES["csv"],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+
+    # file sementara di disk (otomatis terhapus saat ditutup), bukan BytesIO
+    fh = tempfile.TemporaryFile()
+    if fmt == "xlsx":
+        write_fleet_xlsx(fh, targets, rollups, days)
+    else:
+        write_fleet_parquet(fh, targets, rollups, days, pa, pq)
+    fh.seek(0)
+    logging.info(f"📥 Ekspor {fmt} {len(targets)} kendaraan x {len(days)} hari")
+    return send_file(fh, download_name=filename, as_attachment=True, mimetype=EXPORT_MIMETYPES[fmt])
+
+
+# =========================== PREWARM ===========================
+# Tiap malam rekap hari kemarin untuk semua kendaraan aktif dihitung duluan,
+# supaya dashboard (default: kemarin) langsung dilayani dari historical.db.
+PREWARM_AT = os.getenv("PREWARM_AT", "")  # "HH:MM" waktu Jakarta, kosong = nonaktif
+
+# prewarm_status tidak pernah diubah di tempat: tiap perubahan menerbitkan dict
+# baru (set_prewarm_status), jadi /prewarm/status selalu membaca snapshot utuh
+prewarm_status = {
+    "running": False,
+    "date": None,
+    "started_at": None,
+    "finished_at": None,
+    "total": 0,
+    "done": 0,
+    "failed": [],
+    "next_run": None
+}
+_prewarm_lock = threading.Lock()
+_prewarm_status_lock = threading.Lock()
+
+
+def set_prewarm_status(**changes):
+    global prewarm_status
+    with _prewarm_status_lock:
+        prewarm_status = {**prewarm_status, **changes}
+    return prewarm_status
+
+
+def prewarm_day(date_str=None):
+    """Hitung rekap satu hari (default kemarin) untuk semua kendaraan Aktif"""
+    date_str = date_str or local_yesterday()
+    if not _prewarm_lock.acquire(blocking=False):
+        logging.warning(f"⏳ Prewarm {prewarm_status['date']} masih berjalan, {date_str} dilewati")
+        return prewarm_status
+
+    try:
+        vehicles = get_active_vehicles()
+        jobs = [
+            (str(v["imei"]), v["plate"], date_str, date_str, v["fuel_type"] or "None")
+            for v in vehicles
+        ]
+        set_prewarm_status(
+            running=True,
+            date=date_str,
+            started_at=datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"),
+            finished_at=None,
+            total=len(jobs),
+            done=0,
+            failed=[]
+        )
+        logging.info(f"🌙 Prewarm {date_str}: {len(jobs)} kendaraan aktif")
+
+        futures = {_fetch_pool.submit(ensure_rollups, *job): job for job in jobs}
+        done, failed = 0, []
+        for fut in as_completed(futures):
+            job = futures[fut]
+            try:
+                fut.result()
+                if date_str not in get_stored_days(job[0], date_str, date_str):
+                    raise GPSError("data API belum lengkap, akan diambil ulang")
+            except Exception as e:
+                failed.append({"plate": job[1], "imei": job[0], "error": str(e)})
+                logging.error(f"❌ Prewarm {job[1]} gagal → {e}")
+            done += 1
+            set_prewarm_status(done=done, failed=list(failed))
+            logging.info(f"🌙 Prewarm {date_str}: {done}/{len(jobs)} ({job[1]})")
+
+        set_prewarm_status(finished_at=datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"))
+        logging.info(f"✅ Prewarm {date_str} selesai, {len(failed)} gagal")
+    finally:
+        set_prewarm_status(running=False)
+        _prewarm_lock.release()
+    return prewarm_status
+
+
+def next_prewarm_time(now=None):
+    now = now or datetime.now(LOCAL_TZ)
+    hour, minute = (int(x) for x in PREWARM_AT.split(":"))
+    run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at
+
+
+def _prewarm_loop():
+    while True:
+        run_at = next_prewarm_time()
+        set_prewarm_status(next_run=run_at.strftime("%Y-%m-%d %H:%M:%S"))
+        time.sleep((run_at - datetime.now(LOCAL_TZ)).total_seconds())
+        try:
+            prewarm_day()
+        except Exception:
+            logging.exception("🚨 Error di prewarm")
+
+
+def start_prewarm_scheduler():
+    if not PREWARM_AT:
+        return
+    threading.Thread(target=_prewarm_loop, name="prewarm", daemon=True).start()
+    logging.info(f"🌙 Prewarm terjadwal tiap {PREWARM_AT} WIB")
+
+
+@app.route('/prewarm/status')
+def prewarm_status_route():
+    return jsonify(prewarm_status)
+
+
 if __name__ == "__main__":
     init_db()
+    init_history_store()
+    init_historical_db()
+
+    # Worker CLI (mis. dari cron): python main.py prewarm [YYYY-MM-DD]
+    if len(sys.argv) > 1 and sys.argv[1] == "prewarm":
+        status = prewarm_day(sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(1 if status["failed"] else 0)
+
+    # reloader debug menjalankan dua proses; scheduler cukup di proses anak
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_prewarm_scheduler()
+        vehicle_snapshot.start()
     app.run(debug=True, host="127.0.0.1", port=5000)
@@ -33,30 +33,24 @@ document.addEventListener("DOMContentLoaded", function () {
       .bindPopup(`<b>FINISH</b><br>${end.DatetimeUTC}`)
   );
 
-  // Deteksi STOP dan PARKIR
-  for (let i = 1; i < markers.length; i++) {
+  // STOP dan PARKIR dari hasil segmentasi server (satu marker per stop)
+  (stops || []).forEach(s => {
+    const minutes = Math.round(s.duration_s / 60);
+    const label = s.type === "parking" ? "PARKIR" : "STOP";
+    clusterGroup.addLayer(
+      L.marker(s.location, { icon: s.type === "parking" ? parkingIcon() : stopIcon() })
+        .bindPopup(`<b>${label}</b> ${minutes} menit<br>${s.start_time} - ${s.end_time}`)
+    );
+  });
+
+  // Posisi saat bergerak
+  for (let i = 1; i < markers.length - 1; i++) {
     const p = markers[i];
-    const latlng = [p.Lat, p.Lon];
-
-    const isParkir = p.engine == 0 && p.speed == 0;
-    const isStop = p.speed == 0 && p.engine != 0;
-
-    if (isParkir) {
-      clusterGroup.addLayer(
-        L.marker(latlng, { icon: parkingIcon() })
-          .bindPopup(`<b>PARKIR</b><br>${p.DatetimeUTC}`)
-      );
-    } else if (isStop) {
-      clusterGroup.addLayer(
-        L.marker(latlng, { icon: stopIcon() })
-          .bindPopup(`<b>STOP</b><br>${p.DatetimeUTC}`)
-      );
-    } else {
-      clusterGroup.addLayer(
-        L.marker(latlng, { icon: smallIcon() })
-          .bindPopup(`<b>POSISI</b><br>${p.DatetimeUTC}`)
-      );
-    }
+    if (!p.speed) continue;
+    clusterGroup.addLayer(
+      L.marker([p.Lat, p.Lon], { icon: smallIcon() })
+        .bindPopup(`<b>POSISI</b><br>${p.DatetimeUTC}<br>${p.speed} km/h`)
+    );
   }
 
   map.addLayer(clusterGroup);
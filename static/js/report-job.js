@@ -0,0 +1,46 @@
+// Rekap periode dijalankan sebagai job di server: submit, polling progress,
+// lalu buka hasil job itu sendiri (tanpa merekap ulang di request baru).
+document.addEventListener("DOMContentLoaded", function () {
+  const form = document.getElementById("historical-form");
+  const progressText = document.getElementById("job-progress");
+  if (!form) return;
+
+  form.addEventListener("submit", function (e) {
+    const data = new FormData(form);
+    if (!data.get("start_date") || !data.get("end_date")) return;
+
+    e.preventDefault();
+    showLoading();
+
+    fetch("/historical/jobs", { method: "POST", body: data })
+      .then(res => res.json())
+      .then(job => {
+        if (!job.success) throw new Error(job.message);
+        poll(job.status_url, job.report_url);
+      })
+      .catch(err => {
+        progressText.textContent = "Gagal membuat job: " + err.message;
+      });
+
+    function poll(url, reportUrl) {
+      fetch(url)
+        .then(res => res.json())
+        .then(p => {
+          if (p.state === "done") {
+            window.location = reportUrl;
+            return;
+          }
+          if (p.state === "error") {
+            progressText.textContent = "Gagal: " + p.error;
+            return;
+          }
+          let text = `${p.vehicles_done}/${p.vehicles_total} kendaraan, ${p.days_done}/${p.days_total} hari`;
+          if (p.vehicles_failed) text += `, ${p.vehicles_failed} gagal`;
+          if (p.eta_seconds !== null) text += ` (sisa ± ${Math.ceil(p.eta_seconds)} detik)`;
+          progressText.textContent = text;
+          setTimeout(() => poll(url, reportUrl), 2000);
+        })
+        .catch(() => setTimeout(() => poll(url, reportUrl), 5000));
+    }
+  });
+});
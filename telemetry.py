@@ -0,0 +1,267 @@
+"""Store telemetry per hari (telemetry.db).
+
+Titik GPS per (imei, tanggal) disimpan permanen di SQLite. Hari yang sudah
+lewat tidak pernah berubah, jadi cukup diambil dari API sekali saja; hari yang
+lengkap ditandai di history_days. Fetch dari API ada di main.py (HISTORY
+INGEST); modul ini hanya skema, baca, dan tulis store.
+"""
+import os
+import sqlite3
+import threading
+import logging
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from dotenv import load_dotenv
+
+from aggregation import history_columns
+
+load_dotenv()  # HISTORY_DB boleh di-set lewat .env, sama seperti main.py
+
+HISTORY_DB = os.getenv("HISTORY_DB", "telemetry.db")
+HISTORY_FIELDS = ("time", "mileage", "speed", "lat", "lon", "engine")
+LOCAL_TZ = ZoneInfo("Asia/Jakarta")
+
+_history_db_ready = False
+_init_lock = threading.Lock()
+_geo_rtree = False  # modul rtree tersedia di SQLite ini (dicek saat init)
+
+
+def init_history_store():
+    global _history_db_ready
+    with _init_lock:
+        _init_history_store()
+    _history_db_ready = True
+
+
+def _init_history_store():
+    global _geo_rtree
+    conn = sqlite3.connect(HISTORY_DB)
+    c = conn.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS history_points (
+            imei TEXT,
+            date TEXT,
+            time TEXT,
+            mileage REAL,
+            speed REAL,
+            lat REAL,
+            lon REAL,
+            engine INTEGER
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_points ON history_points (imei, date, time)")
+    # hari yang sudah lengkap tersimpan (termasuk hari tanpa data)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS history_days (
+            imei TEXT,
+            date TEXT,
+            point_count INTEGER,
+            fetched_at TEXT,
+            PRIMARY KEY (imei, date)
+        )
+    """)
+    # track yang sudah disederhanakan per level zoom (lihat TRACK API di main.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS track_pyramids (
+            imei TEXT,
+            date TEXT,
+            level INTEGER,
+            payload TEXT,
+            PRIMARY KEY (imei, date, level)
+        )
+    """)
+    # trip & stop hasil segmentasi (lihat TRIP & STOP di main.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS trips (
+            imei TEXT,
+            date TEXT,
+            kind TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            start_lat REAL,
+            start_lon REAL,
+            end_lat REAL,
+            end_lon REAL,
+            distance_km REAL,
+            duration_s INTEGER,
+            moving_s INTEGER,
+            idle_s INTEGER,
+            max_speed REAL,
+            point_count INTEGER
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trips ON trips (imei, date, start_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trips_kind ON trips (kind, start_time)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS trip_days (
+            imei TEXT,
+            date TEXT,
+            trip_count INTEGER,
+            stop_count INTEGER,
+            PRIMARY KEY (imei, date)
+        )
+    """)
+    # bucket titik untuk index spasial (lihat GEOFENCE di main.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS geo_buckets (
+            id INTEGER PRIMARY KEY,
+            imei TEXT,
+            date TEXT,
+            seq INTEGER,
+            start_time TEXT,
+            end_time TEXT,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL,
+            point_count INTEGER
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_geo_buckets ON geo_buckets (imei, date, seq)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS geo_days (
+            imei TEXT,
+            date TEXT,
+            bucket_count INTEGER,
+            PRIMARY KEY (imei, date)
+        )
+    """)
+    try:
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS geo_index
+            USING rtree(id, min_lon, max_lon, min_lat, max_lat, min_t, max_t)
+        """)
+        _geo_rtree = True
+    except sqlite3.OperationalError as e:
+        logging.warning(f"⚠️ SQLite tanpa rtree ({e}), query geofence pakai tabel geo_buckets")
+    conn.commit()
+    conn.close()
+
+
+def geo_rtree_available():
+    """Modul rtree tersedia di SQLite ini (dicek saat store diinisialisasi)"""
+    if not _history_db_ready:
+        init_history_store()
+    return _geo_rtree
+
+
+def history_conn():
+    if not _history_db_ready:
+        init_history_store()
+    return sqlite3.connect(HISTORY_DB, timeout=30)
+
+
+def local_today():
+    return datetime.now(LOCAL_TZ).strftime("%Y-%m-%d")
+
+
+def local_yesterday():
+    return (datetime.now(LOCAL_TZ) - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def date_range(start_date, end_date):
+    start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    return [(start_dt + timedelta(days=i)).strftime("%Y-%m-%d")
+            for i in range((end_dt - start_dt).days + 1)]
+
+
+def contiguous_runs(dates):
+    """['01','02','04'] -> [('01','02'), ('04','04')] (tanggal sudah urut)"""
+    runs = []
+    for d in dates:
+        prev = (datetime.strptime(d, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        if runs and runs[-1][1] == prev:
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+    return [tuple(r) for r in runs]
+
+
+def get_stored_days(imei, start_date, end_date):
+    conn = history_conn()
+    c = conn.cursor()
+    c.execute("SELECT date FROM history_days WHERE imei=? AND date BETWEEN ? AND ?",
+              (imei, start_date, end_date))
+    rows = c.fetchall()
+    conn.close()
+    return {r[0] for r in rows}
+
+
+def load_stored_history(imei, start_date, end_date):
+    conn = history_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT {", ".join(HISTORY_FIELDS)}
+        FROM history_points
+        WHERE imei=? AND date BETWEEN ? AND ?
+        ORDER BY time
+    """, (imei, start_date, end_date))
+    rows = c.fetchall()
+    conn.close()
+    return [dict(zip(HISTORY_FIELDS, r)) for r in rows]
+
+
+def save_history_chunk(conn, imei, days, rows):
+    """Ganti titik hari-hari `days` dan tandai lengkap, dalam satu transaksi.
+
+    Hari yang ternyata sudah lengkap (diisi thread / worker lain selama fetch)
+    dilewati, jadi ingest ganda untuk hari yang sama tidak mengubah apa pun.
+    Return hari yang benar-benar ditulis.
+    """
+    if not days:
+        return []
+    fetched_at = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    with conn:
+        # kunci tulis diambil sebelum cek, supaya cek + tulis tidak diselip worker lain
+        conn.execute("BEGIN IMMEDIATE")
+        complete = {r[0] for r in conn.execute(
+            "SELECT date FROM history_days WHERE imei=? AND date BETWEEN ? AND ?",
+            (imei, days[0], days[-1]))}
+        days = [d for d in days if d not in complete]
+        rows = [r for r in rows if r[1] not in complete]
+        counts = dict.fromkeys(days, 0)
+        for row in rows:
+            counts[row[1]] += 1
+        conn.executemany("DELETE FROM history_points WHERE imei=? AND date=?", [(imei, d) for d in days])
+        conn.executemany(
+            "INSERT INTO history_points (imei, date, time, mileage, speed, lat, lon, engine) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        conn.executemany("""
+            INSERT OR REPLACE INTO history_days (imei, date, point_count, fetched_at)
+            VALUES (?, ?, ?, ?)
+        """, [(imei, d, counts[d], fetched_at) for d in days])
+    return days
+
+
+def iter_day_columns(imei, start_date, end_date, open_points=None):
+    """Generator (tanggal, kolom NumPy) per hari; yang di memori hanya satu hari"""
+    open_points = open_points or {}
+    conn = history_conn()
+    cur = conn.execute("""
+        SELECT date, time, mileage, speed
+        FROM history_points
+        WHERE imei=? AND date BETWEEN ? AND ? AND time IS NOT NULL AND mileage IS NOT NULL
+        ORDER BY date, time
+    """, (imei, start_date, end_date))
+    try:
+        for day, rows in groupby(cur, key=itemgetter(0)):
+            if day in open_points:
+                continue
+            rows = list(rows)
+            yield day, {
+                "imei": np.full(len(rows), imei, dtype=object),
+                "time": np.array([r[1] for r in rows], dtype="U19"),
+                "mileage": np.array([r[2] for r in rows], dtype=float),
+                "speed": np.array([r[3] or 0 for r in rows], dtype=float),
+            }
+    finally:
+        conn.close()
+    for day in sorted(open_points):
+        if start_date <= day <= end_date:
+            yield day, history_columns(open_points[day], imei)